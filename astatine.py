@@ -1,9 +1,13 @@
 import base64
 import bottle_pxsession as bottle_pxsession
-import subprocess, threading, string, sqlite3, random, os, json, hashlib, functools, hashlib, datetime
+import subprocess, threading, string, sqlite3, random, os, json, hashlib, functools, hashlib, datetime, contextlib, itertools
+import re, time, secrets, concurrent.futures, mimetypes, email.utils, gzip, inspect, signal, socket, socketserver, traceback
+import smtplib, heapq, email.message, bisect, math
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from collections import OrderedDict
 from urllib.parse import urlparse
 
-from bottle import Bottle, static_file, abort, request, redirect
+from bottle import Bottle, abort, debug, request, response, redirect, HTTPResponse, HTTPError, parse_date, parse_range_header
 
 aes_disabled = False
 try:
@@ -13,6 +17,12 @@ try:
 except ModuleNotFoundError:
     aes_disabled = True
 
+brotli_disabled = False
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli_disabled = True
+
 sqlDir = '/views/sql'
 
 
@@ -38,13 +48,13 @@ class Astatine(object):
         self._server = server
         self._quiet = quiet
         self._cursor = None
+        self._pool = None
         self._sql_name = sql_name
         self._dirs = ['views/', 'views/css/',  'views/svg/',
                       'views/js/', 'views/data/', 'views/fnt/', 'views/img/',
                       'user_data/', 'sql/']
         self._plugin_manager = None
         self._session_plugin = None
-        self._lock = threading.Lock()
         self._days = 100
         self._hours = 24
         self._minutes = 60
@@ -54,14 +64,26 @@ class Astatine(object):
         self.cursor = self._cursor
         self.has_sessions = False
         self.uid_length = 20
+        self.uids = AstatineUID(length=self.uid_length)
         self._db = None
         self._db_c = None
-
-        self._static_files_ext = ['css', 'scss', 'less', 'png', 'jpg', 'jpeg', 'gif', 'tiff',
-                                  'psd', 'raw', 'svg', 'ico', 'js', 'otf', 'ttf', 'eot', 'webp',
-                                  'woff', 'woff2', 'mp4', 'mov', 'wmv', 'avi', 'mkv', 'mpeg-2', 'webm',
-                                  'mp3', 'wav', 'ogg', 'pdf']
+        self._db_lock = threading.Lock()
+        self._banned_ips = set()
+        self.visitor_counter = None
+        self.metrics = None
+        self.rate_limiter = None
+        self._rate_limit_exempt = ()
+        self.trusted_proxies = frozenset()
+
+        self._static_files_ext = frozenset(['css', 'scss', 'less', 'png', 'jpg', 'jpeg', 'gif', 'tiff',
+                                            'psd', 'raw', 'svg', 'ico', 'js', 'otf', 'ttf', 'eot', 'webp',
+                                            'woff', 'woff2', 'mp4', 'mov', 'wmv', 'avi', 'mkv', 'mpeg-2', 'webm',
+                                            'mp3', 'wav', 'ogg', 'pdf'])
+        self._static_mimetypes = {ext: self._static_mimetype(ext) for ext in self._static_files_ext}
         self._image_ext = ['png', 'jpg', 'jpeg', 'gif', 'svg', 'ico', '']
+        self._compressible_ext = ['css', 'scss', 'less', 'svg', 'ico', 'js', 'otf', 'ttf', 'eot']
+        self.static_cache = AstatineStaticCache(self._compressible_ext)
+        self.response_cache = AstatineResponseCache()
 
         if self._sql_name:
             self._setup_sql()
@@ -69,6 +91,8 @@ class Astatine(object):
         self._setup_astatine()
         self._setup_db()
         self._route()
+        self.visitor_counter = AstatineVisitorCounter(self._db, self._db_lock)
+        self.visitor_counter.start()
 
     def __contains__(self, route):
         if route in self.app.routes:
@@ -78,12 +102,15 @@ class Astatine(object):
 
     def _setup_sql(self):
         """Creates SQLite3 database."""
-        self._conn = sqlite3.connect('{}'.format(self._sql_name), check_same_thread=False)
+        self._pool = AstatineConnectionPool(self._sql_name)
+        self._conn = self._pool.connection()
         self._cursor = self._conn.cursor()
         self.cursor = self._cursor
 
     def _setup_db(self):
         self._db = sqlite3.connect('sql/site_data.db', check_same_thread=False)
+        # several worker processes may write to it in prefork mode
+        self._db.execute('PRAGMA journal_mode=WAL')
         self._db_c = self._db.cursor()
         self._db_c.execute('''
             CREATE TABLE IF NOT EXISTS ip_bans (
@@ -91,30 +118,131 @@ class Astatine(object):
                 ip_hash TEXT UNIQUE NOT NULL
             )
         ''')
-        self._db_c.execute('''
-            CREATE TABLE IF NOT EXISTS visitors (
-                datetime INTEGER NOT NULL,
-                visits INTEGER NOT NULL DEFAULT 0
-            )
-        ''')
-        self._db_c.execute('''
-            CREATE TABLE IF NOT EXISTS unique_visitors (
-                datetime INTEGER NOT NULL,
-                visits INTEGER NOT NULL DEFAULT 0
-            )
-        ''')
-        self._db_c.execute('''
-            CREATE TABLE IF NOT EXISTS visitor_referral (
-                datetime INTEGER NOT NULL,
-                referral TEXT NOT NULL,
-                visits INTEGER NOT NULL DEFAULT 0
-            )
-        ''')
+        if self._db_c.execute('PRAGMA user_version').fetchone()[0] < 1:
+            self._migrate_analytics()
+        self._load_bans()
+
+    def _load_bans(self):
+        """Reads the ban list, in prefork mode also to pick up bans made by the other workers."""
+        with self._db_lock:
+            self._banned_ips = {row[0] for row in self._db.execute('SELECT ip_hash FROM ip_bans')}
+
+    def _migrate_analytics(self):
+        """
+        Creates the visitor tables keyed by day, or by day and referral, and the weekly and
+        monthly rollups. Tables from before the keys existed are copied over, merging rows
+        for the same day, and the rollups are computed from them.
+        """
+        tables = ('visitors', 'unique_visitors', 'visitor_referral')
+        with self._db:
+            c = self._db.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for table in tables:
+                if table in existing:
+                    c.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table))
+            c.execute('''
+                CREATE TABLE visitors (
+                    datetime INTEGER PRIMARY KEY,
+                    visits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE unique_visitors (
+                    datetime INTEGER PRIMARY KEY,
+                    visits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE visitor_referral (
+                    datetime INTEGER NOT NULL,
+                    referral TEXT NOT NULL,
+                    visits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (datetime, referral)
+                ) WITHOUT ROWID
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS visitor_rollup (
+                    period TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    visits INTEGER NOT NULL DEFAULT 0,
+                    unique_visits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (period, start)
+                ) WITHOUT ROWID
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS referral_rollup (
+                    period TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    referral TEXT NOT NULL,
+                    visits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (period, start, referral)
+                ) WITHOUT ROWID
+            ''')
+            if 'visitors_old' in existing or 'visitors' in existing:
+                c.execute('INSERT INTO visitors SELECT datetime, SUM(visits) FROM visitors_old GROUP BY datetime')
+            if 'unique_visitors' in existing:
+                c.execute('''
+                    INSERT INTO unique_visitors SELECT datetime, SUM(visits) FROM unique_visitors_old GROUP BY datetime
+                ''')
+            if 'visitor_referral' in existing:
+                c.execute('''
+                    INSERT INTO visitor_referral
+                    SELECT datetime, referral, SUM(visits) FROM visitor_referral_old GROUP BY datetime, referral
+                ''')
+            for table in tables:
+                if table in existing:
+                    c.execute('DROP TABLE {}_old'.format(table))
+            c.execute('DELETE FROM visitor_rollup')
+            c.execute('DELETE FROM referral_rollup')
+            AstatineVisitorCounter.write_rollups(
+                c,
+                dict(c.execute('SELECT datetime, visits FROM visitors').fetchall()),
+                dict(c.execute('SELECT datetime, visits FROM unique_visitors').fetchall()),
+                {(day, referral): visits for day, referral, visits
+                 in c.execute('SELECT datetime, referral, visits FROM visitor_referral').fetchall()})
+            c.execute('PRAGMA user_version = 1')
+            c.close()
+
+    def visitor_stats(self, start, end, period='day'):
+        """
+        :param start: First day, as a date, datetime or timestamp.
+        :param end: Last day, included.
+        :param period: 'day', 'week' or 'month', weeks start on monday.
+        :return: A list of dicts, one per period with visits, oldest first, with its start timestamp,
+            visits and unique visits under 'start', 'visits' and 'unique'.
+        """
+        self.visitor_counter.flush()
+        first, last = AstatineVisitorCounter.period_range(start, end, period)
+        with self._db_lock:
+            rows = self._db.execute('''
+                SELECT start, visits, unique_visits FROM visitor_rollup
+                WHERE period = ? AND start BETWEEN ? AND ? ORDER BY start
+            ''', (period, first, last)).fetchall()
+        return [{'start': row[0], 'visits': row[1], 'unique': row[2]} for row in rows]
+
+    def top_referrers(self, start, end, limit=10, period='day'):
+        """
+        :param start: First day, as a date, datetime or timestamp.
+        :param end: Last day, included.
+        :param limit: How many referrers to return.
+        :param period: The rollup to add up, 'week' or 'month' read fewer rows over long ranges
+            but widen the range to whole weeks or months.
+        :return: A list of (referral, visits) tuples, most visits first.
+        """
+        self.visitor_counter.flush()
+        first, last = AstatineVisitorCounter.period_range(start, end, period)
+        with self._db_lock:
+            return self._db.execute('''
+                SELECT referral, SUM(visits) AS total FROM referral_rollup
+                WHERE period = ? AND start BETWEEN ? AND ?
+                GROUP BY referral ORDER BY total DESC, referral LIMIT ?
+            ''', (period, first, last, limit)).fetchall()
 
     def _end_sql(self):
         self._db_c.close()
         self._db.commit()
-        self._conn.commit()
+        self._pool.close()
 
     def _setup_astatine(self):
         """Creates all directories."""
@@ -122,31 +250,256 @@ class Astatine(object):
             if not os.path.exists(directory):
                 os.makedirs(directory)
 
-    def _download_file(self, filepath) -> static_file:
+    def _download_file(self, filepath, cipher=None) -> HTTPResponse:
         if filepath.split('/')[0] == 'user_data':
-            return static_file(filepath, root="", download=filepath)
+            if cipher:
+                return self.send_encrypted_file(filepath, "", cipher, download=os.path.basename(filepath))
+            return self.send_file(filepath, root="", download=os.path.basename(filepath))
         else:
             abort(403)
 
-    def _static_files(self, filepath) -> static_file:
-        name, ext = os.path.splitext(filepath)
-        favicon = False
-        if ext[1:] in self._static_files_ext:
-            favicon = True if ext[1:] == 'ico' else False
-            return static_file(filepath, '', parameters=request.query) if not favicon else static_file(filepath, '', mimetype='image/x-icon', parameters=request.query)
+    _static_mimetype_overrides = {'ico': 'image/x-icon', 'scss': 'text/x-scss', 'less': 'text/css',
+                                  'mkv': 'video/x-matroska', 'mpeg-2': 'video/mpeg', 'webm': 'video/webm',
+                                  'woff': 'font/woff', 'woff2': 'font/woff2', 'otf': 'font/otf', 'ttf': 'font/ttf',
+                                  'eot': 'application/vnd.ms-fontobject', 'psd': 'image/vnd.adobe.photoshop'}
+
+    @staticmethod
+    def _static_mimetype(ext):
+        mimetype = Astatine._static_mimetype_overrides.get(ext) or mimetypes.guess_type('file.' + ext)[0] \
+            or 'application/octet-stream'
+        if mimetype[:5] == 'text/' or mimetype == 'application/javascript':
+            mimetype += '; charset=UTF-8'
+        return mimetype
+
+    def add_static_extension(self, ext, mimetype=None):
+        """
+        Serve files with this extension from /s/.
+        :param ext: The extension, without the dot.
+        :param mimetype: The Content-Type to send, guessed from the extension by default.
+        """
+        ext = ext.lstrip('.').lower()
+        mimetypes_ = dict(self._static_mimetypes)
+        mimetypes_[ext] = mimetype or self._static_mimetype(ext)
+        # replaced rather than mutated, so requests being served never see a half-updated table
+        self._static_mimetypes = mimetypes_
+        self._static_files_ext = frozenset(mimetypes_)
+
+    def remove_static_extension(self, ext):
+        """
+        Stop serving files with this extension from /s/, they will get a 404.
+        :param ext: The extension, without the dot.
+        """
+        ext = ext.lstrip('.').lower()
+        mimetypes_ = dict(self._static_mimetypes)
+        mimetypes_.pop(ext, None)
+        self._static_mimetypes = mimetypes_
+        self._static_files_ext = frozenset(mimetypes_)
+
+    def _static_files(self, filepath) -> HTTPResponse:
+        mimetype = self._static_mimetypes.get(os.path.splitext(filepath)[1][1:].lower())
+        if mimetype is None:
+            abort(404, 'Could not find file "{}"'.format(filepath))
+        return self.static_cache.serve(filepath, '', mimetype=mimetype)
+
+    def precompress_static(self, directory='views/'):
+        """
+        Builds the gzip (and brotli, if installed) variants of every compressible static file
+        under directory, so that the first requests do not pay for compressing them.
+        :return: The number of variants written
+        """
+        return self.static_cache.precompress(directory)
+
+    @staticmethod
+    def _etag(stats, encoding=None):
+        """The ETag of a file, shared by send_file and AstatineStaticCache so both agree on it."""
+        return '"{:x}-{:x}-{:x}{}"'.format(stats.st_ino, stats.st_mtime_ns, stats.st_size,
+                                           '-' + encoding if encoding else '')
+
+    @staticmethod
+    def _etag_matches(header, etag, weak=True):
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return True
+            if weak and tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    @staticmethod
+    def _file_ranges(filename, ranges, chunk_size, parts=None):
+        with open(filename, 'rb') as fp:
+            for i, (start, end) in enumerate(ranges):
+                if parts:
+                    yield parts[i]
+                fp.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = fp.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            if parts:
+                yield parts[-1]
+
+    @staticmethod
+    def send_file(filename, root, mimetype=True, download=False, charset='UTF-8', headers=None, chunk_size=262144,
+                  max_ranges=16):
+        """
+        Serves a file with ETag and Last-Modified validation (304), single and multiple byte
+        ranges (206, multipart/byteranges) and If-Range. Whole files are handed to the server's
+        wsgi.file_wrapper, which lets servers that support it send them without copying in Python.
+        :param filename: Path of the file, relative to root.
+        :param root: The directory files are served from, requests outside of it get 403.
+        :param mimetype: The Content-Type, True to guess it from the extension.
+        :param download: True or a filename to send the file as an attachment.
+        :param headers: Extra headers for the response.
+        :param chunk_size: Bytes read at a time when sending ranges.
+        :param max_ranges: Requests for more ranges than this get the whole file.
+        :return: HTTPResponse or HTTPError
+        """
+        root = os.path.join(os.path.abspath(root), '')
+        filename = os.path.abspath(os.path.join(root, filename.strip('/\\')))
+        headers = dict(headers) if headers else {}
+        getenv = request.environ.get
+
+        if not filename.startswith(root):
+            return HTTPError(403, 'Access denied.')
+        try:
+            stats = os.stat(filename)
+        except OSError:
+            return HTTPError(404, 'File does not exist.')
+        if not os.path.isfile(filename):
+            return HTTPError(404, 'File does not exist.')
+        if not os.access(filename, os.R_OK):
+            return HTTPError(403, 'You do not have permission to access this file.')
+
+        if mimetype is True:
+            mimetype, encoding = mimetypes.guess_type(download if isinstance(download, str) else filename)
+            mimetype = mimetype or 'application/octet-stream'
+        if charset and mimetype and 'charset=' not in mimetype \
+                and (mimetype[:5] == 'text/' or mimetype == 'application/javascript'):
+            mimetype += '; charset=%s' % charset
+        if download:
+            download = os.path.basename(filename) if download is True else download
+            headers['Content-Disposition'] = 'attachment; filename="%s"' % download.replace('"', '')
+
+        size = stats.st_size
+        etag = Astatine._etag(stats)
+        headers['ETag'] = etag
+        headers['Last-Modified'] = email.utils.formatdate(stats.st_mtime, usegmt=True)
+        headers['Date'] = email.utils.formatdate(time.time(), usegmt=True)
+        headers['Accept-Ranges'] = 'bytes'
+
+        if_none_match = getenv('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            if Astatine._etag_matches(if_none_match, etag):
+                return HTTPResponse(status=304, **headers)
         else:
-            print('Error 404: Could not find file "{}"'.format(filepath))
+            ims = getenv('HTTP_IF_MODIFIED_SINCE')
+            ims = parse_date(ims.split(';')[0].strip()) if ims else None
+            if ims is not None and ims >= int(stats.st_mtime):
+                return HTTPResponse(status=304, **headers)
+
+        if mimetype:
+            headers['Content-Type'] = mimetype
+        head = request.method == 'HEAD'
+
+        range_header = getenv('HTTP_RANGE')
+        if_range = getenv('HTTP_IF_RANGE')
+        if range_header and if_range:
+            # a stale If-Range means the client's partial copy is outdated, send everything
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                range_header = range_header if if_range == etag else None
+            else:
+                date = parse_date(if_range)
+                range_header = range_header if date is not None and date >= int(stats.st_mtime) else None
+
+        if range_header:
+            ranges = list(parse_range_header(range_header, size))
+            if not ranges:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return HTTPError(416, 'Requested Range Not Satisfiable', **headers)
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+                headers['Content-Length'] = str(end - start)
+                body = '' if head else Astatine._file_ranges(filename, ranges, chunk_size)
+                return HTTPResponse(body, status=206, **headers)
+            if len(ranges) <= max_ranges:
+                boundary = secrets.token_hex(16)
+                parts = ['--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                    boundary, headers.get('Content-Type', 'application/octet-stream'), start, end - 1, size)
+                    for start, end in ranges]
+                parts = [(part if i == 0 else '\r\n' + part).encode('ascii') for i, part in enumerate(parts)]
+                parts.append('\r\n--{}--\r\n'.format(boundary).encode('ascii'))
+                headers['Content-Type'] = 'multipart/byteranges; boundary={}'.format(boundary)
+                headers['Content-Length'] = str(sum(map(len, parts)) + sum(end - start for start, end in ranges))
+                body = '' if head else Astatine._file_ranges(filename, ranges, chunk_size, parts)
+                return HTTPResponse(body, status=206, **headers)
+
+        headers['Content-Length'] = str(size)
+        body = '' if head else open(filename, 'rb')
+        return HTTPResponse(body, **headers)
+
+    @staticmethod
+    def send_encrypted_file(filename, root, cipher, mimetype=True, download=False, charset='UTF-8', headers=None):
+        """
+        Serves a file encrypted with AstatineAES.encrypt_file or upload_files(cipher=...), decrypting
+        it chunk by chunk as it is sent. Ranges are not supported. A chunk that fails authentication
+        ends the response early, after the chunks before it have been sent.
+        :param filename: Path of the file, relative to root.
+        :param root: The directory files are served from, requests outside of it get 403.
+        :param cipher: The AstatineAES instance the file was encrypted with.
+        :param mimetype: The Content-Type, True to guess it from the extension.
+        :param download: True or a filename to send the file as an attachment.
+        :param headers: Extra headers for the response.
+        :return: HTTPResponse or HTTPError
+        """
+        root = os.path.join(os.path.abspath(root), '')
+        filename = os.path.abspath(os.path.join(root, filename.strip('/\\')))
+        headers = dict(headers) if headers else {}
+
+        if not filename.startswith(root):
+            return HTTPError(403, 'Access denied.')
+        if not os.path.isfile(filename):
+            return HTTPError(404, 'File does not exist.')
+        if not os.access(filename, os.R_OK):
+            return HTTPError(403, 'You do not have permission to access this file.')
+
+        if mimetype is True:
+            mimetype, encoding = mimetypes.guess_type(download if isinstance(download, str) else filename)
+            mimetype = mimetype or 'application/octet-stream'
+        if charset and mimetype and 'charset=' not in mimetype \
+                and (mimetype[:5] == 'text/' or mimetype == 'application/javascript'):
+            mimetype += '; charset=%s' % charset
+        if download:
+            download = os.path.basename(filename) if download is True else download
+            headers['Content-Disposition'] = 'attachment; filename="%s"' % download.replace('"', '')
+        headers['Content-Type'] = mimetype
+        try:
+            headers['Content-Length'] = str(cipher.plaintext_size(filename))
+        except ValueError:
+            return HTTPError(500, 'Not an encrypted file.')
+
+        def body():
+            with open(filename, 'rb') as f:
+                for chunk in cipher.iter_decrypt(f):
+                    yield chunk
+
+        if request.method == 'HEAD':
+            return HTTPResponse('', **headers)
+        return HTTPResponse(body(), **headers)
 
     def _route(self):
         static_files = functools.partial(self._static_files, filepath='filepath')
         df = functools.partial(self._download_file, filepath='filepath')
 
-        all_extensions = []
-        for i in self._static_files_ext:
-            all_extensions.append(i)
-
         # self.app.route("/download/<filepath:path>", method='GET', callback=df)
-        self.app.route("/s/<filepath:re:.*\\.({})>".format("|".join(all_extensions)), method='GET', callback=static_files)
+        # extensions are checked against self._static_mimetypes in _static_files, not in the route pattern
+        self.app.route("/s/<filepath:path>", method='GET', callback=static_files)
 
     def track_visitor(self, session, domains: list):
         """
@@ -155,80 +508,250 @@ class Astatine(object):
             :return:
         """
 
-        target_ip = request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')
-        hashed_ip = hashlib.sha256(bytes(target_ip, 'utf-8')).hexdigest()
-
-        if self._db_c.execute('SELECT TRUE FROM ip_bans WHERE ip_hash = ?', (hashed_ip,)).fetchone():
-            abort(403)
-        date_current = datetime.datetime.now().timestamp()
-        date_start = datetime.datetime.combine(datetime.datetime.now(), datetime.time.min).timestamp()
-
-        check_date_start = self._db_c.execute('SELECT * FROM visitors WHERE datetime = ?', (int(date_start),))
-
-        if urlparse(request.environ.get('HTTP_REFERER')).netloc not in domains:
-            if not check_date_start.fetchone():
-                self._db_c.execute('''
-                    INSERT INTO visitor_referral (datetime, referral, visits) VALUES (?,?,?)
-                ''', (int(date_start), request.environ.get('HTTP_REFERER'), 1))
-            else:
-                if session['last_visit'] and session['last_visit'] < date_start:
-                    self._db_c.execute('''
-                        UPDATE visitor_referral SET visits = visits + 1 WHERE datetime = ? AND referral = ?
-                    ''', (int(date_start), request.environ.get('HTTP_REFERER')))
-                    session['last_visit'] = date_start
-                elif not session['last_visit']:
-                    self._db_c.execute('''
-                        UPDATE visitor_referral SET visits = visits + 1 WHERE datetime = ? AND referral = ?
-                    ''', (int(date_start), request.environ.get('HTTP_REFERER')))
-                    session['last_visit'] = date_start
-
-        if not session['last_visit']:
-            self._db_c.execute('''UPDATE unique_visitors SET visits = visits + 1''')
-
-        if not check_date_start.fetchone():
-            self._db_c.execute('''
-                INSERT INTO visitors (datetime, visits) VALUES (?,?)
-            ''', (int(date_start), 1))
-        else:
-            if session['last_visit'] and session['last_visit'] < date_start:
-                self._db_c.execute('''
-                    UPDATE visitors SET visits = visits + 1 WHERE datetime = ?
-                ''', (int(date_start),))
-                session['last_visit'] = date_start
-            elif not session['last_visit']:
-                self._db_c.execute('''
-                    UPDATE visitors SET visits = visits + 1 WHERE datetime = ?
-                ''', (int(date_start),))
-                session['last_visit'] = date_start
-
-        self._db.commit()
+        if self.metrics is not None:
+            start = time.perf_counter()
+            try:
+                return self._track_visitor(session, domains)
+            finally:
+                self.metrics.observe('track_visitor', time.perf_counter() - start)
+        return self._track_visitor(session, domains)
+
+    def _track_visitor(self, session, domains):
+        self.check_ban()
+        now = datetime.datetime.now()
+        date_current = now.timestamp()
+        date_start = int(datetime.datetime.combine(now, datetime.time.min).timestamp())
+
+        # each session is counted once per day, the counts are written in batches by self.visitor_counter
+        last_visit = session['last_visit']
+        if not last_visit or last_visit < date_start:
+            referral = request.environ.get('HTTP_REFERER')
+            if referral and urlparse(referral).netloc in domains:
+                referral = None
+            self.visitor_counter.add(date_start, unique=not last_visit, referral=referral)
 
         session['last_visit'] = date_current
 
-    def enable_sessions(self):
+    def enable_sessions(self, write_behind=True, backend='file', lazy=True, cookie_secret=None, cookie_key=None,
+                        max_cookie_size=3800, sweep_interval=60, **store_options):
         """
         Enable session usage in routes.
+        :param write_behind: Write each session at most once, at the end of the request, instead of on every assignment.
+        :param backend: 'file', 'memory', 'sqlite' or a bottle_pxsession.SessionStore instance.
+        :param lazy: Only load a session when the route uses it, and only store it once something is written.
+        :param cookie_secret: Keep session data in a signed cookie instead of the backend, which is then only used for sessions larger than max_cookie_size.
+        :param cookie_key: Also encrypt cookie sessions with AstatineAES using this key.
+        :param max_cookie_size: The largest session cookie, in bytes, before falling back to the backend.
+        :param sweep_interval: Seconds between background passes deleting expired sessions, None to disable.
+        :param store_options: Extra arguments for the store, e.g. max_sessions for 'memory', path for 'sqlite' or shard_depth for 'file'.
         :return:
         """
-        self._session_plugin = bottle_pxsession.SessionPlugin(cookie_lifetime=self._life)
+        cipher = None
+        if cookie_key:
+            if aes_disabled:
+                raise RuntimeError('pycryptodomex is needed to encrypt session cookies')
+            cipher = AstatineAES(cookie_key)
+        if backend == 'sqlite':
+            store_options.setdefault('path', 'sql/sessions.db')
+        elif backend == 'file':
+            store_options.setdefault('shard_depth', 1)
+        store = bottle_pxsession.create_store(backend, **store_options)
+        self._session_plugin = bottle_pxsession.SessionPlugin(cookie_lifetime=self._life, write_behind=write_behind,
+                                                              store=store, lazy=lazy, secret=cookie_secret,
+                                                              cipher=cipher, max_cookie_size=max_cookie_size,
+                                                              sweep_interval=sweep_interval)
+        if self.metrics is not None:
+            self._session_plugin.observe = self.metrics.observe
         self.ss = self.app.install(self._session_plugin)
         self.has_sessions = True
 
-    def route(self, name, method, function, sessions=False, **kwargs):
+    def enable_metrics(self, route='/metrics', buckets=None):
+        """
+        Records the latency and status codes of every route, and the time spent in execute_sql,
+        session loading and saving and track_visitor, see AstatineMetrics.
+        :param route: Where to serve the metrics in Prometheus text format, None to not serve them.
+        :param buckets: Upper bounds in seconds of the latency histogram buckets.
+        :return: The AstatineMetrics instance.
+        """
+        self.metrics = AstatineMetrics(buckets)
+        self.app.install(self.metrics)
+        # the first plugin wraps all the others, so session loading and saving is part of the latency
+        self.app.plugins.remove(self.metrics)
+        self.app.plugins.insert(0, self.metrics)
+        self.app.reset()
+        if self._session_plugin:
+            self._session_plugin.observe = self.metrics.observe
+        if route:
+            self.app.route(route, method='GET', callback=self._metrics_page)
+        return self.metrics
+
+    def _metrics_page(self):
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return self.metrics.render()
+
+    def route(self, name, method, function, sessions=False, cache=None, rate_limit=None, **kwargs):
         """
         :param name: The route/name
         :param method: 'GET', 'PUT', 'DELETE' or 'POST'
         :param function: The function/method to link to the route.
         :param sessions: Whether this route should use sessions.
+        :param cache: Cache the rendered page, either the seconds to keep it for or a dict of
+            ttl, query (include the query string in the key, default True), headers (request
+            headers to include), session (session fields to include) and key (a function
+            returning the key instead).
+        :param rate_limit: Limit how often each client may call this route, either the requests per
+            minute or a dict of the arguments of AstatineRateLimiter, see enable_rate_limit.
         :param args: provide extra arguments to the function.
         :return:
         """
         fn = functools.partial(function, kwargs) if kwargs else function
+        if cache:
+            fn = self._cached_route(name, fn, cache if isinstance(cache, dict) else {'ttl': cache})
+        if rate_limit:
+            limiter = AstatineRateLimiter(**(rate_limit if isinstance(rate_limit, dict) else {'rate': rate_limit}))
+            fn = self._rate_limited_route(fn, limiter)
         if not sessions:
             self.app.route(name, method=method, callback=fn)
         elif sessions and self.has_sessions:
             self.app.route(name, method=method, callback=fn, apply=[self.ss])
 
+    def _cached_route(self, name, fn, options):
+        ttl = options.get('ttl', 60)
+        use_query = options.get('query', True)
+        header_names = options.get('headers', ())
+        session_fields = options.get('session', ())
+        key_function = options.get('key')
+        cache = self.response_cache
+
+        def cached(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return fn(*args, **kwargs)
+            if key_function:
+                extra = key_function(*args, **kwargs)
+            else:
+                session = kwargs.get('session')
+                extra = (request.query_string if use_query else '',
+                         tuple(request.headers.get(h) for h in header_names),
+                         tuple(session[f] for f in session_fields) if session is not None else ())
+            key = (name, request.path, extra)
+
+            entry = cache.get(key)
+            if entry is None:
+                body = fn(*args, **kwargs)
+                # a cookie belongs to one visitor, so pages setting one are not shared
+                if response.status_code != 200 or not isinstance(body, (str, bytes)) or response._cookies \
+                        or 'Set-Cookie' in response.headers or self._session_pending(kwargs.get('session')):
+                    return body
+                headers = [(header, value) for header, value in response.headers.allitems()
+                           if header not in ('Content-Length', 'ETag')]
+                entry = cache.put(key, body, headers, ttl)
+            else:
+                replaced = set()
+                for header, value in entry['headers']:
+                    if header in replaced:
+                        response.add_header(header, value)
+                    else:
+                        response.set_header(header, value)
+                        replaced.add(header)
+
+            response.set_header('ETag', entry['etag'])
+            if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+            if if_none_match and self._etag_matches(if_none_match, entry['etag']):
+                return HTTPResponse(status=304, ETag=entry['etag'])
+            return entry['body']
+
+        # plugins such as sessions look at the callback's arguments, so keep the original signature
+        cached.__signature__ = inspect.signature(fn)
+        return cached
+
+    @staticmethod
+    def _session_pending(session):
+        """
+        Whether the session plugin will still write the session and set its cookie after the
+        handler has returned, as write-behind sessions do.
+        """
+        if session is None or not getattr(session, 'loaded', True):
+            return False
+        # a lazy new session only gets a cookie once it is written to, i.e. once it is dirty
+        return session.dirty or (session._cookie_pending and not session.lazy)
+
+    def _rate_limited_route(self, fn, limiter):
+        def limited(*args, **kwargs):
+            self._check_rate_limit(limiter)
+            return fn(*args, **kwargs)
+
+        limited.__signature__ = inspect.signature(fn)
+        return limited
+
+    def enable_rate_limit(self, rate, per=60, burst=None, ban_after=None, ban_window=3600, max_clients=100000,
+                          exempt=('/s/',), trusted_proxies=None):
+        """
+        Limits the requests of each client to every route, rejecting the excess with 429 before
+        routing. Banned clients are rejected with 403. Routes can have their own, additional,
+        limits through the rate_limit option of route.
+        :param rate: Requests allowed per period.
+        :param per: The period in seconds.
+        :param burst: Requests allowed at once after a quiet period, defaults to rate.
+        :param ban_after: Ban a client with ip_ban once it has been rejected this many times within ban_window seconds.
+            Rejections are counted per process. With run_astatine(workers=...) the other workers load new bans
+            from the database every visitor_counter.flush_interval seconds.
+        :param ban_window: Seconds over which rejections are counted for ban_after.
+        :param max_clients: How many clients are tracked, the least recently seen are forgotten first.
+        :param exempt: Path prefixes that are not limited, e.g. static files.
+        :param trusted_proxies: Addresses of reverse proxies whose X-Forwarded-For is believed, see peer_ip.
+            Route limits use them too.
+        :return: The AstatineRateLimiter instance.
+        """
+        if trusted_proxies is not None:
+            self.trusted_proxies = frozenset(trusted_proxies)
+        self.rate_limiter = AstatineRateLimiter(rate, per, burst, ban_after, ban_window, max_clients)
+        self._rate_limit_exempt = tuple(exempt or ())
+        self.app.add_hook('before_request', self._rate_limit_hook)
+        return self.rate_limiter
+
+    def _rate_limit_hook(self):
+        if self._rate_limit_exempt and request.path.startswith(self._rate_limit_exempt):
+            return
+        self._check_rate_limit(self.rate_limiter)
+
+    def peer_ip(self):
+        """
+        The address rate limits and automatic bans are keyed on. Unlike client_ip, X-Forwarded-For is
+        only used behind one of self.trusted_proxies, and then only its right-most hop that is not a
+        trusted proxy, since clients can put anything in the header.
+        """
+        ip = request.environ.get('REMOTE_ADDR')
+        if ip in self.trusted_proxies:
+            for hop in reversed(request.environ.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+                hop = hop.strip()
+                if hop and hop not in self.trusted_proxies:
+                    return hop
+        return ip
+
+    def _check_rate_limit(self, limiter):
+        ip = self.peer_ip()
+        if not ip:
+            return
+        hashed_ip = self.hash_ip(ip)
+        if hashed_ip in self._banned_ips:
+            abort(403)
+        retry_after, strikes = limiter.hit(hashed_ip)
+        if not retry_after:
+            return
+        if limiter.ban_after and strikes >= limiter.ban_after:
+            self.ip_ban(ip)
+        raise HTTPError(429, 'Too Many Requests', **{'Retry-After': str(math.ceil(retry_after))})
+
+    def purge_cache(self, route=None, path=None):
+        """
+        Drops cached pages, see the cache option of route. With run_astatine(workers=...) only
+        the pages of the worker process handling this call are dropped.
+        :param route: Only drop pages of this route name.
+        :param path: Only drop pages for this request path.
+        :return: How many pages were dropped
+        """
+        return self.response_cache.purge(route, path)
+
     def error(self, code, function):
         """
         :param code: Error code to pair with the function, can pass singular code or list of codes
@@ -249,57 +772,97 @@ class Astatine(object):
         combo = numbers + letters + specials if special else numbers + letters
         return ''.join(random.choice(combo) for i in range(string_length))
 
-    def generate_uid(self, table_name, id_name, length=20):
-        is_unique, new_id = False, None
-        off_length = length or self.uid_length
-        while not is_unique:
-            new_id = self.random_string(off_length)
-            table = self._cursor.execute(f"SELECT {id_name} FROM {table_name} WHERE {id_name} = ?", (new_id,))
-            for t in table:
-                if not t:
-                    is_unique = False
-                else:
-                    is_unique = True
-            is_unique = True if not [t for t in table] else False
-        return new_id
+    def generate_uid(self, table_name=None, id_name=None, length=None):
+        """
+        Returns a random id from self.uids without querying the table, the id column's
+        UNIQUE constraint is what guarantees uniqueness, see insert_uid.
+        :param table_name: Unused, kept for compatibility.
+        :param id_name: Unused, kept for compatibility.
+        :param length: The id length, defaults to uid_length.
+        """
+        return self.uids.next(length or self.uid_length)
+
+    def insert_uid(self, table_name, id_name, values, length=None, attempts=5):
+        """
+        Inserts a row with a newly generated id, retrying with a new id if it collides.
+        :param table_name: The table to insert into
+        :param id_name: The UNIQUE id column
+        :param values: A dict of the other column names and values
+        :param length: The id length, defaults to uid_length.
+        :param attempts: How many ids to try before giving up
+        :return: The new row's id
+        """
+        return self._pool.insert_unique(table_name, id_name, values,
+                                        functools.partial(self.uids.next, length or self.uid_length), attempts)
+
+    @staticmethod
+    def _save_upload(file, filepath, max_file_size, hash_name, buf_size=65536, cipher=None):
+        """
+        Streams one upload into a temporary file next to filepath, hashing it on the
+        way, and renames it into place once it is complete. With a cipher the file is
+        encrypted as it is written, the hash and size are those of the upload itself.
+        """
+        digest = hashlib.new(hash_name)
+        byte_count = 0
+        # opened like a normal file so the saved upload gets the usual umask permissions
+        temp_path = os.path.join(os.path.dirname(filepath), '.upload-{}'.format(secrets.token_hex(8)))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                out = cipher.writer(f) if cipher else f
+                buf = file.file.read(buf_size)
+                while buf:
+                    byte_count += len(buf)
+                    if byte_count > max_file_size:
+                        abort(413)
+                    digest.update(buf)
+                    out.write(buf)
+                    buf = file.file.read(buf_size)
+                if cipher:
+                    out.close()
+            os.replace(temp_path, filepath)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return {'path': filepath, 'hash': digest.hexdigest(), 'size': byte_count}
 
     @staticmethod
-    def upload_files(files, extensions, path, max_file_size=52428800, rename=None):
+    def upload_files(files, extensions, path, max_file_size=52428800, rename=None, hash_name='sha256', workers=4,
+                     cipher=None):
         """
         :param files: A list of the files
         :param extensions: Any list of extensions or '*' to allow any
         :param path: The path the file will be saved to.
         :param max_file_size: The maximum file size per file.
         :param rename: provide extra arguments to the function.
-        :return:
+        :param hash_name: The hashlib algorithm used to hash each file as it is saved.
+        :param workers: How many files of a multi-file upload are saved at the same time.
+        :param cipher: An AstatineAES instance to encrypt the saved files with, see send_encrypted_file.
+        :return: A list of dicts with the path, hash and size of each saved file.
         """
-        if not os.path.exists(path):
+        if path and not os.path.exists(path):
             os.makedirs(path)
 
-        FILEPATH = None
-        BUF_SIZE = 8192
+        uploads = []
+        for file in files:
+            name, ext = os.path.splitext(file.filename)
+            filename = name + ext.lower()
+            if ext in extensions or extensions == '*':
+                if rename:
+                    FILEPATH = path + rename + ext if path else rename + ext
+                else:
+                    FILEPATH = path + filename if path else filename
+                uploads.append((file, FILEPATH))
 
         try:
-            for file in files:
-                name, ext = os.path.splitext(file.filename)
-                filename = name + ext.lower()
-                if ext in extensions or extensions == '*':
-                    if rename:
-                        FILEPATH = path + rename + ext if path else rename + ext
-                    else:
-                        FILEPATH = path + filename if path else filename
-                    byte_count = 0
-                    data_blocks = []
-                    buf = file.file.read(BUF_SIZE)
-                    while buf:
-                        byte_count += len(buf)
-                        if byte_count > max_file_size:
-                            abort(413)
-                        data_blocks.append(buf)
-                        buf = file.file.read(BUF_SIZE)
-                    data = b''.join(data_blocks)
-                    with open(FILEPATH, 'wb') as f:
-                        f.write(data)
+            if len(uploads) < 2 or workers < 2:
+                return [Astatine._save_upload(file, filepath, max_file_size, hash_name, cipher=cipher)
+                        for file, filepath in uploads]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(uploads))) as executor:
+                futures = [executor.submit(Astatine._save_upload, file, filepath, max_file_size, hash_name, cipher=cipher)
+                           for file, filepath in uploads]
+                return [future.result() for future in futures]
         except IOError:
             redirect(request.environ['HTTP_REFERER'])
 
@@ -307,10 +870,37 @@ class Astatine(object):
     def remove_file(file_name):
         os.remove(str(file_name))
 
+    @staticmethod
+    def client_ip():
+        return request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def hash_ip(ip):
+        """SHA-256 of an IP address, memoized so repeat clients are not rehashed."""
+        return hashlib.sha256(bytes(ip, 'utf-8')).hexdigest()
+
     def ip_ban(self, ip=None):
-        target_ip = ip if ip else request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')
-        hashed_ip = hashlib.sha256(bytes(target_ip, 'utf-8')).hexdigest()
-        self._db_c.execute('INSERT INTO ip_bans (uid, ip_hash) VALUES (?,?)', (self.random_string(8), hashed_ip))
+        hashed_ip = self.hash_ip(ip if ip else self.client_ip())
+        with self._db_lock:
+            self._db.execute('INSERT OR IGNORE INTO ip_bans (uid, ip_hash) VALUES (?,?)', (self.random_string(8), hashed_ip))
+            self._db.commit()
+        self._banned_ips.add(hashed_ip)
+
+    def is_banned(self, ip=None):
+        """
+        :param ip: The IP to check, defaults to the current client.
+        :return: Whether the IP has been banned, checked against the in-memory ban list.
+        """
+        target_ip = ip if ip else self.client_ip()
+        return bool(target_ip) and self.hash_ip(target_ip) in self._banned_ips
+
+    def check_ban(self, ip=None):
+        """
+        Throws code 403 if the IP, or the current client, is banned. Can be used in any route.
+        """
+        if self.is_banned(ip):
+            abort(403)
 
     @staticmethod
     def check_type(var, var_type):
@@ -319,10 +909,146 @@ class Astatine(object):
         else:
             abort(422)
 
-    def run_astatine(self):
+    def _close_resources(self):
+        """Flushes and closes the databases, visitor counter and session store."""
+        self.visitor_counter.stop()
+        if self._sql_name:
+            self._end_sql()
+        self._db.commit()
+        if self._session_plugin:
+            self._session_plugin.close()
+
+    def _reopen_resources(self, worker_id):
+        """Opens fresh connections and threads in a forked worker, none are inherited from the parent."""
+        self.uids.reset()
+        self._setup_db()
+        if self._sql_name:
+            self._conn = self._pool.connection()
+            self._cursor = self._conn.cursor()
+            self.cursor = self._cursor
+        self.visitor_counter = AstatineVisitorCounter(self._db, self._db_lock, on_flush=self._load_bans)
+        self.visitor_counter.start()
+        if self._session_plugin:
+            self._session_plugin.reopen(sweep=worker_id == 0)
+
+    def _listen(self, reuse_port=False, backlog=1024):
+        sock = socket.socket(socket.AF_INET6 if ':' in self._host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self._host, self._port))
+        sock.listen(backlog)
+        return sock
+
+    def _run_worker(self, sock, worker_id, max_requests, reuse_port):
+        """Serves requests in a forked worker until it is told to stop or has served max_requests."""
+        stopping = []
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: stopping.append(signum))
+        if reuse_port:
+            sock = self._listen(reuse_port=True)
+        self._reopen_resources(worker_id)
+
+        server = AstatineWorkerServer(sock, self.app, self._quiet)
+        try:
+            while not stopping and (not max_requests or server.handled < max_requests):
+                server.handle_request()
+        finally:
+            # waits for requests still being handled
+            server.server_close()
+
+    def _spawn_worker(self, sock, worker_id, max_requests, reuse_port):
+        pid = os.fork()
+        if pid:
+            return pid
+        code = 0
+        try:
+            self._run_worker(sock, worker_id, max_requests, reuse_port)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                self._close_resources()
+            finally:
+                os._exit(code)
+
+    def _run_prefork(self, workers, max_requests, reuse_port):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Prefork mode needs os.fork, which this platform does not have')
+        if self._session_plugin and isinstance(self._session_plugin.store, bottle_pxsession.MemorySessionStore):
+            print('Warning: in-memory sessions are not shared between worker processes')
+        if self._pool.cache is not None and not self._pool.cache.ttl:
+            print('Warning: the query cache has no ttl, a worker process keeps serving results that '
+                  'other workers have changed, see enable_query_cache')
+        if self._session_plugin and isinstance(self._session_plugin.store, bottle_pxsession.SQLiteSessionStore):
+            # a batch left uncommitted in one worker would lock every other worker out of the table
+            # until the store's commit thread commits it, commit_interval seconds later
+            self._session_plugin.store.commit_every = 1
+        debug(self._debug)
+        sock = None if reuse_port else self._listen()
+        # nothing is opened before fork, every worker opens its own connections
+        self._close_resources()
+        self._db.close()
+
+        flags = {'stop': False, 'restart': False}
+
+        def on_signal(signum, frame):
+            flags['restart' if signum == signal.SIGHUP else 'stop'] = True
+
+        previous = {signum: signal.signal(signum, on_signal) for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+        if not self._quiet:
+            print('Astatine prefork: {} workers listening on http://{}:{}/ (SIGHUP restarts gracefully)'.format(
+                workers, self._host, self._port))
+
+        generation, stopping, children = 0, False, {}
+        try:
+            for worker_id in range(workers):
+                children[self._spawn_worker(sock, worker_id, max_requests, reuse_port)] = (worker_id, generation)
+            while children:
+                if flags['stop'] and not stopping:
+                    stopping = True
+                    for pid in children:
+                        os.kill(pid, signal.SIGTERM)
+                if flags['restart'] and not stopping:
+                    # start a new set of workers, the old ones finish their requests and exit
+                    flags['restart'] = False
+                    generation += 1
+                    old = list(children)
+                    for worker_id in range(workers):
+                        children[self._spawn_worker(sock, worker_id, max_requests, reuse_port)] = (worker_id, generation)
+                    for pid in old:
+                        os.kill(pid, signal.SIGTERM)
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    time.sleep(0.1)
+                    continue
+                worker_id, worker_generation = children.pop(pid, (None, None))
+                if not stopping and worker_generation == generation:
+                    # recycled after max_requests, or crashed
+                    children[self._spawn_worker(sock, worker_id, max_requests, reuse_port)] = (worker_id, generation)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            if sock:
+                sock.close()
+
+    def run_astatine(self, workers=None, max_requests=None, reuse_port=False):
         """
         Run the bottle website.
+        :param workers: Run this many worker processes instead of one server, sharing the listening socket.
+            Send SIGHUP to the main process for a graceful restart. The reloader and server options are not
+            used in this mode, each worker runs a threaded wsgiref server.
+        :param max_requests: Replace a worker with a fresh one after it has served this many requests.
+        :param reuse_port: Give each worker its own socket with SO_REUSEPORT instead of sharing one.
+            Each worker keeps its own query cache and cached pages, writes and purge_cache only clear
+            those of the worker they run in, the others keep them until their ttl runs out.
         """
+        if workers:
+            return self._run_prefork(workers, max_requests, reuse_port)
         try:
             if self._server:
                 self.app.run(host=self._host,
@@ -338,33 +1064,71 @@ class Astatine(object):
                              reloader=self._reload,
                              quiet=self._quiet)
         finally:
-            if self._sql_name:
-                self._end_sql()
-            self._db.commit()
+            self._close_resources()
 
-    def execute_sql(self, query, values=None, fetchall=True):
+    def execute_sql(self, query, values=None, fetchall=True, cache=True):
         """
         :param query: The SQLite3 query you want to make
         :param values: Any values you need to pass into the SQLite3 query
         :param fetchall: Whether it should <fetchall> or <fetchone>, default is True
+        :param cache: Whether a SELECT may be answered from the query cache, if it is enabled
         :return
         """
-        execution = None
+        if self.metrics is None:
+            return self._pool.execute(query, values, fetchall, cache)
+        start = time.perf_counter()
         try:
-            self._lock.acquire(True)
-            if values:
-                execution = self._cursor.execute(query, values).fetchall() if fetchall else self._cursor.execute(query, values).fetchone()
-                self._conn.commit()
-            else:
-                execution = self._cursor.execute(query).fetchall() if fetchall else self._cursor.execute(query).fetchone()
-                self._conn.commit()
+            return self._pool.execute(query, values, fetchall, cache)
         finally:
-            self._lock.release()
-            return execution
+            self.metrics.observe('execute_sql', time.perf_counter() - start)
+
+    def enable_query_cache(self, max_entries=1024, ttl=None):
+        """
+        Cache the results of SELECTs made through execute_sql. Entries are dropped
+        when this instance writes to a table they read from. With run_astatine(workers=...)
+        that is only the writing worker's entries, so set a ttl there.
+        :param max_entries: The most results to keep, least recently used are evicted first
+        :param ttl: Seconds a result stays valid, None to only expire on writes
+        :return: The AstatineQueryCache, see its stats() and clear()
+        """
+        self._pool.cache = AstatineQueryCache(max_entries, ttl)
+        return self._pool.cache
+
+    def iter_sql(self, query, values=None, chunk_size=500):
+        """
+        :param query: The SQLite3 query you want to make
+        :param values: Any values you need to pass into the SQLite3 query
+        :param chunk_size: How many rows to fetch from SQLite3 at a time
+        :return: A generator of row tuples. To stream a response, format the rows into str or bytes first,
+            e.g. return ('{},{}\n'.format(*row) for row in iter_sql(...)) from the route.
+        """
+        return self._pool.iterate(query, values, chunk_size)
+
+    def transaction(self):
+        """
+        Context manager that runs its block as a single transaction, e.g.
+        with sql.transaction() as conn: conn.execute(...)
+        """
+        return self._pool.transaction()
+
+    def executemany(self, query, rows, batch_size=10000):
+        """
+        :param query: The SQLite3 query to run for each row
+        :param rows: An iterable or generator of value tuples
+        :param batch_size: How many rows to commit at a time
+        :return: The number of rows affected
+        """
+        return self._pool.executemany(query, rows, batch_size)
+
+    def executescript(self, script):
+        """
+        :param script: Several SQLite3 statements, run and committed together
+        """
+        self._pool.executescript(script)
 
     def create_function_sql(self, name, parameters, callback):
         sqlite3.enable_callback_tracebacks(True)
-        self._conn.create_function(name, parameters, callback)
+        self._pool.create_function(name, parameters, callback)
 
 
 class AstatineSQL(object):
@@ -374,66 +1138,998 @@ class AstatineSQL(object):
         self._path = path
         self._cursor = None
         self._conn = None
-        self._lock = threading.Lock()
+        self._pool = None
+        self.uids = AstatineUID()
         self.connect()
 
     def connect(self):
         """Creates SQLite3 database."""
-        self._conn = sqlite3.connect('{}'.format(self._path), check_same_thread=False)
+        self._pool = AstatineConnectionPool(self._path)
+        self._conn = self._pool.connection()
         self._cursor = self._conn.cursor()
 
     def commit(self):
-        self._conn.commit()
+        self._pool.connection().commit()
 
     def close(self):
         self._cursor.close()
+        self._pool.close()
 
-    def execute_sql(self, query, values=None, fetchall=True):
+    def execute_sql(self, query, values=None, fetchall=True, cache=True):
         """
         :param query: The SQLite3 query you want to make
         :param values: Any values you need to pass into the SQLite3 query
         :param fetchall: Whether it should <fetchall> or <fetchone>
+        :param cache: Whether a SELECT may be answered from the query cache, if it is enabled
         :return:
         """
-        execution = None
-        try:
-            self._lock.acquire(True)
-            if values:
-                execution = self._cursor.execute(query, values).fetchall() if fetchall else self._cursor.execute(query, values).fetchone()
-                self._conn.commit()
-            else:
-                execution = self._cursor.execute(query).fetchall() if fetchall else self._cursor.execute(query).fetchone()
-                self._conn.commit()
-        finally:
-            self._lock.release()
-            return execution
+        return self._pool.execute(query, values, fetchall, cache)
+
+    def enable_query_cache(self, max_entries=1024, ttl=None):
+        """
+        Cache the results of SELECTs made through execute_sql. Entries are dropped
+        when this instance writes to a table they read from.
+        :param max_entries: The most results to keep, least recently used are evicted first
+        :param ttl: Seconds a result stays valid, None to only expire on writes
+        :return: The AstatineQueryCache, see its stats() and clear()
+        """
+        self._pool.cache = AstatineQueryCache(max_entries, ttl)
+        return self._pool.cache
+
+    def iter_sql(self, query, values=None, chunk_size=500):
+        """
+        :param query: The SQLite3 query you want to make
+        :param values: Any values you need to pass into the SQLite3 query
+        :param chunk_size: How many rows to fetch from SQLite3 at a time
+        :return: A generator of row tuples. To stream a response, format the rows into str or bytes first,
+            e.g. return ('{},{}\n'.format(*row) for row in iter_sql(...)) from the route.
+        """
+        return self._pool.iterate(query, values, chunk_size)
+
+    def transaction(self):
+        """
+        Context manager that runs its block as a single transaction, e.g.
+        with sql.transaction() as conn: conn.execute(...)
+        """
+        return self._pool.transaction()
+
+    def executemany(self, query, rows, batch_size=10000):
+        """
+        :param query: The SQLite3 query to run for each row
+        :param rows: An iterable or generator of value tuples
+        :param batch_size: How many rows to commit at a time
+        :return: The number of rows affected
+        """
+        return self._pool.executemany(query, rows, batch_size)
+
+    def executescript(self, script):
+        """
+        :param script: Several SQLite3 statements, run and committed together
+        """
+        self._pool.executescript(script)
 
     def create_function_sql(self, name, parameters, callback):
         sqlite3.enable_callback_tracebacks(True)
-        self._conn.create_function(name, parameters, callback)
+        self._pool.create_function(name, parameters, callback)
 
     @staticmethod
     def random_string(string_length, special=False):
         specials = '!£$%&*;:@~#<>,./?'
-        combo = string.ascii_letters + string.digits + (specials if special else None)
+        combo = string.ascii_letters + string.digits + (specials if special else '')
         return ''.join(random.choice(combo) for i in range(string_length))
 
-    def generate_uid(self, table_name, id_name, length=20):
-        is_unique, new_id = False, None
-        while not is_unique:
-            new_id = self.random_string(length)
-            table = self._cursor.execute(f"SELECT {id_name} FROM {table_name} WHERE {id_name} = ?", (new_id,))
-            for t in table:
-                if not t:
-                    is_unique = False
-                else:
-                    is_unique = True
-            is_unique = True if not [t for t in table] else False
-        return new_id
+    def generate_uid(self, table_name=None, id_name=None, length=20):
+        """
+        Returns a random id from self.uids without querying the table, the id column's
+        UNIQUE constraint is what guarantees uniqueness, see insert_uid.
+        """
+        return self.uids.next(length)
+
+    def insert_uid(self, table_name, id_name, values, length=20, attempts=5):
+        """
+        Inserts a row with a newly generated id, retrying with a new id if it collides.
+        :param table_name: The table to insert into
+        :param id_name: The UNIQUE id column
+        :param values: A dict of the other column names and values
+        :param length: The id length
+        :param attempts: How many ids to try before giving up
+        :return: The new row's id
+        """
+        return self._pool.insert_unique(table_name, id_name, values, functools.partial(self.uids.next, length), attempts)
+
+
+class AstatineStaticCache(object):
+    """
+    Serves static files with Accept-Encoding negotiation and an in-memory LRU.
+
+    Compressible files get .gz (and .br, with the brotli module) siblings, built on
+    first request or by precompress(), and rebuilt when the original is newer.
+    Files up to max_file_size are kept in memory, up to max_bytes in total, and
+    are checked against the original's mtime and size on every request, so only
+    a stat reaches the disk. Fingerprinted names such as app.3f9a1c2b.js get
+    long-lived immutable cache headers. The hash needs at least one letter, so that
+    dated names such as clip-20240101.mp4 are not taken for fingerprints. Anything else, and any Range request,
+    is passed on to Astatine.send_file.
+    """
+
+    _fingerprint = re.compile(r'[.-](?=[0-9]*[a-fA-F])[0-9a-fA-F]{8,}\.\w+$')
+    _suffixes = {'br': '.br', 'gzip': '.gz'}
+
+    def __init__(self, compressible_ext, max_file_size=262144, max_bytes=33554432, immutable_max_age=31536000):
+        self.compressible_ext = set(compressible_ext)
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes
+        self.immutable_max_age = immutable_max_age
+        self.encodings = ['gzip'] if brotli_disabled else ['br', 'gzip']
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._incompressible = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _compress(data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data)
+        return gzip.compress(data, 9, mtime=0)
+
+    def _accepted(self, header):
+        """Returns the encodings this cache can produce that header accepts, best first."""
+        accepted = {}
+        for item in header.split(','):
+            name, _, params = item.strip().partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        default = accepted.get('*', 0.0)
+        return [e for e in self.encodings if accepted.get(e, default) > 0]
+
+    def variant(self, path, stats, encoding):
+        """
+        Returns the path of an up to date compressed copy of path, building it if needed,
+        or None if compressing does not make the file smaller or the copy cannot be written.
+        A copy that cannot be written is kept in memory instead when it fits, see serve.
+        """
+        variant_path = path + self._suffixes[encoding]
+        try:
+            if os.stat(variant_path).st_mtime_ns >= stats.st_mtime_ns:
+                return variant_path
+        except OSError:
+            pass
+        if self._incompressible.get((path, encoding)) == stats.st_mtime_ns:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        compressed = self._compress(data, encoding)
+        if len(compressed) >= len(data):
+            self._incompressible[(path, encoding)] = stats.st_mtime_ns
+            return None
+        temp_path = '{}.{}.tmp'.format(variant_path, secrets.token_hex(4))
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(temp_path, variant_path)
+        except OSError as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            print('Error: could not write {}: {}'.format(variant_path, e))
+            # either way it is not compressed again on every request
+            if len(compressed) <= self.max_file_size:
+                self._put((path, encoding), self._entry(compressed, stats, encoding))
+            else:
+                self._incompressible[(path, encoding)] = stats.st_mtime_ns
+            return None
+        return variant_path
+
+    def precompress(self, directory):
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                if os.path.splitext(name)[1][1:].lower() not in self.compressible_ext:
+                    continue
+                path = os.path.join(dirpath, name)
+                stats = os.stat(path)
+                for encoding in self.encodings:
+                    if self.variant(path, stats, encoding):
+                        count += 1
+        return count
+
+    def _get(self, key, stats):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['mtime'] != stats.st_mtime_ns or entry['source_size'] != stats.st_size \
+                    or entry['ino'] != stats.st_ino:
+                self._bytes -= len(self._entries.pop(key)['body'])
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old['body'])
+            self._entries[key] = entry
+            self._bytes += len(entry['body'])
+            while self._bytes > self.max_bytes and self._entries:
+                self._bytes -= len(self._entries.popitem(last=False)[1]['body'])
+
+    @staticmethod
+    def _entry(body, stats, encoding):
+        return {'body': body, 'mtime': stats.st_mtime_ns, 'source_size': stats.st_size, 'ino': stats.st_ino,
+                'etag': Astatine._etag(stats, encoding),
+                'last_modified': email.utils.formatdate(stats.st_mtime, usegmt=True)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def serve(self, filename, root, mimetype=True):
+        """
+        :param filename: Path of the file, relative to root.
+        :param root: The directory files are served from.
+        :param mimetype: The Content-Type, True to guess it from the extension.
+        :return: HTTPResponse or HTTPError
+        """
+        root = os.path.join(os.path.abspath(root), '')
+        path = os.path.abspath(os.path.join(root, filename.strip('/\\')))
+        headers = {}
+        if self._fingerprint.search(path):
+            headers['Cache-Control'] = 'public, max-age={}, immutable'.format(self.immutable_max_age)
+        try:
+            stats = os.stat(path)
+        except OSError:
+            stats = None
+        if stats is None or not path.startswith(root) or request.environ.get('HTTP_RANGE'):
+            return Astatine.send_file(filename, root, mimetype=mimetype, headers=headers)
+
+        if mimetype is True:
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if mimetype[:5] == 'text/' or mimetype == 'application/javascript':
+                mimetype += '; charset=UTF-8'
+
+        encoding, source, entry = None, path, None
+        if os.path.splitext(path)[1][1:].lower() in self.compressible_ext:
+            headers['Vary'] = 'Accept-Encoding'
+            for accepted in self._accepted(request.environ.get('HTTP_ACCEPT_ENCODING', '')):
+                entry = self._get((path, accepted), stats)
+                variant = None if entry else self.variant(path, stats, accepted)
+                if entry is None and variant is None:
+                    # a copy that could not be written to disk may have been kept in memory
+                    entry = self._get((path, accepted), stats)
+                if entry or variant:
+                    encoding, source = accepted, variant
+                    break
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        if entry is None:
+            entry = self._get((path, encoding), stats)
+        if entry is None:
+            size = os.stat(source).st_size if encoding else stats.st_size
+            if size > self.max_file_size:
+                return Astatine.send_file(source, '/', mimetype=mimetype, headers=headers)
+            with open(source, 'rb') as f:
+                body = f.read()
+            entry = self._entry(body, stats, encoding)
+            self._put((path, encoding), entry)
+
+        headers['ETag'] = entry['etag']
+        headers['Last-Modified'] = entry['last_modified']
+        if not encoding:
+            # Range requests go to send_file, which serves the uncompressed file with the same ETag
+            headers['Accept-Ranges'] = 'bytes'
+        headers['Date'] = email.utils.formatdate(time.time(), usegmt=True)
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            if Astatine._etag_matches(if_none_match, entry['etag']):
+                return HTTPResponse(status=304, **headers)
+        else:
+            ims = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+            ims = parse_date(ims.split(';')[0].strip()) if ims else None
+            if ims is not None and ims >= int(stats.st_mtime):
+                return HTTPResponse(status=304, **headers)
+
+        headers['Content-Type'] = mimetype
+        headers['Content-Length'] = str(len(entry['body']))
+        return HTTPResponse('' if request.method == 'HEAD' else entry['body'], **headers)
+
+
+class AstatineResponseCache(object):
+    """
+    LRU of rendered route responses, bounded by max_entries and max_bytes, with a
+    TTL per entry. Keys are (route name, path, extra key) tuples.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=67108864):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, headers, ttl):
+        """
+        :param headers: (name, value) pairs the response is replayed with on a hit.
+        """
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        entry = {'body': body, 'headers': headers, 'expires': time.monotonic() + ttl,
+                 'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])}
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry['body'])
+
+    def purge(self, route=None, path=None):
+        with self._lock:
+            keys = [key for key in self._entries
+                    if (route is None or key[0] == route) and (path is None or key[1] == path)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+
+class AstatineRateLimiter(object):
+    """
+    Token bucket per client: every client may make burst requests at once, refilled at
+    rate requests per per seconds. Clients are kept in an LRU of at most max_clients,
+    in memory, so in prefork mode every worker process limits on its own.
+    """
+
+    def __init__(self, rate, per=60, burst=None, ban_after=None, ban_window=3600, max_clients=100000):
+        self.rate = rate
+        self.per = per
+        self.burst = burst or rate
+        self.ban_after = ban_after
+        self.ban_window = ban_window
+        self.max_clients = max_clients
+        self._refill = rate / per
+        self._lock = threading.Lock()
+        # client -> [tokens, last request, rejections, first rejection]
+        self._clients = OrderedDict()
+
+    def hit(self, client):
+        """
+        Takes a token for a request of client.
+        :return: 0 and the rejection count if the request is allowed, otherwise the seconds until
+            the next token and the rejections within ban_window, this one included.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._clients.get(client)
+            if state is None:
+                state = self._clients[client] = [self.burst, now, 0, now]
+                if len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(client)
+                state[0] = min(self.burst, state[0] + (now - state[1]) * self._refill)
+                state[1] = now
+            if state[0] >= 1:
+                state[0] -= 1
+                return 0, state[2]
+            if now - state[3] > self.ban_window:
+                state[2] = 0
+            if not state[2]:
+                state[3] = now
+            state[2] += 1
+            return (1 - state[0]) / self._refill, state[2]
+
+    def reset(self, client=None):
+        """Forgets one client, or all of them."""
+        with self._lock:
+            if client is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(client, None)
+
+    def __len__(self):
+        return len(self._clients)
+
+
+class AstatineMetrics(object):
+    """
+    Bottle plugin recording, per route, a latency histogram, the response status codes
+    and the time spent in sections such as execute_sql, reported through observe.
+
+    Every thread accumulates into its own dicts without locking. render merges them and
+    folds in the totals of threads that have exited. Requests no route matched, e.g. 404
+    pages, are counted under the route label "unmatched". In prefork mode every worker
+    process has its own metrics.
+    """
+    name = 'metrics'
+    api = 2
+
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._retired = self._new_stats()
+        self._app = None
+
+    @staticmethod
+    def _new_stats():
+        # requests: (route, method) -> [per bucket counts..., +Inf count, sum of seconds]
+        # statuses: (route, method, status) -> count
+        # sections: (route, section) -> [count, sum of seconds]
+        return {'route': None, 'start': None, 'requests': {}, 'statuses': {}, 'sections': {}}
+
+    def _stats(self):
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = self._local.stats = self._new_stats()
+            with self._lock:
+                # thread per request servers start a new thread for every request
+                if len(self._threads) >= 256:
+                    self._retire()
+                self._threads.append((threading.current_thread(), stats))
+            return stats
+
+    def _retire(self):
+        """Merges the totals of exited threads into self._retired, the caller holds self._lock."""
+        alive = []
+        for thread, stats in self._threads:
+            if thread.is_alive():
+                alive.append((thread, stats))
+            else:
+                self._merge(self._retired, stats)
+        self._threads = alive
+
+    @staticmethod
+    def _merge(into, stats):
+        for key, counts in list(stats['requests'].items()):
+            total = into['requests'].setdefault(key, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+        for key, count in list(stats['statuses'].items()):
+            into['statuses'][key] = into['statuses'].get(key, 0) + count
+        for key, (count, seconds) in list(stats['sections'].items()):
+            total = into['sections'].setdefault(key, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+
+    def _record(self, stats, route, method, status, seconds):
+        key = (route, method)
+        counts = stats['requests'].get(key)
+        if counts is None:
+            counts = stats['requests'][key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+        key = (route, method, status)
+        stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+
+    def observe(self, section, seconds):
+        """Adds seconds spent in section to the route of the current request."""
+        stats = self._stats()
+        key = (stats['route'] or '', section)
+        total = stats['sections'].get(key)
+        if total is None:
+            total = stats['sections'][key] = [0, 0.0]
+        total[0] += 1
+        total[1] += seconds
+
+    def setup(self, app):
+        self._app = app
+        app.add_hook('before_request', self._before_request)
+        app.add_hook('after_request', self._after_request)
+
+    def _before_request(self):
+        self._stats()['start'] = time.perf_counter()
+
+    def _after_request(self):
+        # matched routes are recorded by apply, which also sees uncaught exceptions
+        if 'bottle.route' in request.environ:
+            return
+        stats = self._stats()
+        if stats['start'] is not None:
+            self._record(stats, 'unmatched', request.method, response.status_code,
+                         time.perf_counter() - stats['start'])
+
+    def apply(self, callback, route):
+        label = route.rule
+        method = route.method
+
+        def wrapper(*args, **kwargs):
+            stats = self._stats()
+            stats['route'] = label
+            start = stats['start'] or time.perf_counter()
+            status = 500
+            try:
+                rv = callback(*args, **kwargs)
+                status = rv.status_code if isinstance(rv, HTTPResponse) else response.status_code
+                return rv
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                self._record(stats, label, method, status, time.perf_counter() - start)
+                stats['route'] = None
+        return wrapper
+
+    def close(self):
+        if self._app is not None:
+            self._app.remove_hook('before_request', self._before_request)
+            self._app.remove_hook('after_request', self._after_request)
+            self._app = None
+
+    def snapshot(self):
+        """:return: The merged totals of every thread, in the format of _new_stats."""
+        total = self._new_stats()
+        with self._lock:
+            self._retire()
+            self._merge(total, self._retired)
+            for thread, stats in self._threads:
+                self._merge(total, stats)
+        return total
+
+    @staticmethod
+    def _labels(**labels):
+        return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for name, value in labels.items())
+
+    def render(self):
+        """:return: The metrics in the Prometheus text exposition format."""
+        stats = self.snapshot()
+        lines = ['# HELP astatine_request_duration_seconds Time spent handling requests, by route.',
+                 '# TYPE astatine_request_duration_seconds histogram']
+        for (route, method), counts in sorted(stats['requests'].items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('astatine_request_duration_seconds_bucket{{{}}} {}'.format(
+                    self._labels(route=route, method=method, le=bound), cumulative))
+            labels = self._labels(route=route, method=method)
+            lines.append('astatine_request_duration_seconds_sum{{{}}} {!r}'.format(labels, counts[-1]))
+            lines.append('astatine_request_duration_seconds_count{{{}}} {}'.format(labels, cumulative))
+        lines += ['# HELP astatine_requests_total Responses sent, by route and status code.',
+                  '# TYPE astatine_requests_total counter']
+        for (route, method, status), count in sorted(stats['statuses'].items()):
+            lines.append('astatine_requests_total{{{}}} {}'.format(
+                self._labels(route=route, method=method, status=status), count))
+        lines += ['# HELP astatine_section_seconds_total Time spent in execute_sql, sessions and track_visitor, by route.',
+                  '# TYPE astatine_section_seconds_total counter']
+        for (route, section), (count, seconds) in sorted(stats['sections'].items()):
+            lines.append('astatine_section_seconds_total{{{}}} {!r}'.format(self._labels(route=route, section=section), seconds))
+        lines += ['# HELP astatine_section_calls_total Calls of execute_sql, session loading and saving and track_visitor, by route.',
+                  '# TYPE astatine_section_calls_total counter']
+        for (route, section), (count, seconds) in sorted(stats['sections'].items()):
+            lines.append('astatine_section_calls_total{{{}}} {}'.format(self._labels(route=route, section=section), count))
+        return '\n'.join(lines) + '\n'
+
+
+class AstatineConnectionPool(object):
+    """
+    Hands each thread its own SQLite3 connection to path, in WAL mode so that
+    reads run alongside a writer instead of queueing behind one global lock.
+    An in-memory database cannot be shared between connections, so ':memory:'
+    uses a single connection behind a lock instead. The connections of threads
+    that have exited are closed whenever a new one is opened, so thread per
+    request servers do not pile up connections.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        # (thread, connection) pairs
+        self._connections = []
+        self._functions = []
+        self._shared = path == ':memory:'
+        self.cache = None
+
+    def _connect(self):
+        conn = sqlite3.connect('{}'.format(self.path), timeout=self.timeout, check_same_thread=False)
+        if not self._shared:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            for name, parameters, callback in self._functions:
+                conn.create_function(name, parameters, callback)
+            self._retire()
+            self._connections.append((threading.current_thread(), conn))
+        return conn
+
+    def _retire(self):
+        """Commits and closes the connections of exited threads, the caller holds self._lock."""
+        if self._shared:
+            return
+        alive = []
+        for thread, conn in self._connections:
+            if thread.is_alive():
+                alive.append((thread, conn))
+            else:
+                conn.commit()
+                conn.close()
+        self._connections = alive
+
+    def connection(self):
+        """Returns the calling thread's connection, opening it on first use."""
+        if self._shared:
+            if not self._connections:
+                self._connect()
+            return self._connections[0][1]
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def locked(self):
+        """Context manager that serialises access when the connection is shared."""
+        return self._lock if self._shared else contextlib.nullcontext()
+
+    def execute(self, query, values=None, fetchall=True, cache=True):
+        """
+        Runs one statement and only commits if it opened a transaction, so plain
+        SELECTs never pay for a commit. Returns None if the statement fails.
+        """
+        in_transaction = getattr(self._local, 'depth', 0)
+        query_cache = self.cache
+        cached = query_cache is not None and cache and not in_transaction and query_cache.is_read(query)
+        if cached:
+            found, execution = query_cache.get(query, values, fetchall)
+            if found:
+                return execution
+            generation = query_cache.generation
+
+        execution = None
+        conn = self.connection()
+        try:
+            with self.locked():
+                cursor = conn.execute(query, values) if values else conn.execute(query)
+                execution = cursor.fetchall() if fetchall else cursor.fetchone()
+                cursor.close()
+                if conn.in_transaction and not in_transaction:
+                    conn.commit()
+            if cached:
+                query_cache.put(query, values, fetchall, execution, generation)
+            elif query_cache is not None and not query_cache.is_read(query):
+                query_cache.invalidate_query(query)
+        finally:
+            return execution
+
+    def iterate(self, query, values=None, chunk_size=500):
+        """
+        Generator over the rows of a query, fetched chunk_size rows at a time so
+        memory stays flat however many rows there are. The cursor is closed when
+        the generator is exhausted, closed or garbage collected.
+        """
+        conn = self.connection()
+        with self.locked():
+            cursor = conn.execute(query, values) if values else conn.execute(query)
+        try:
+            while True:
+                with self.locked():
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs everything inside the with block as one transaction on the calling
+        thread's connection, committed once at the end or rolled back on error.
+        Nested transactions join the outer one.
+        """
+        conn = self.connection()
+        depth = getattr(self._local, 'depth', 0)
+        with self.locked():
+            if depth:
+                self._local.depth = depth + 1
+                try:
+                    yield conn
+                finally:
+                    self._local.depth = depth
+                return
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.depth = 1
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                self._local.depth = 0
+                # statements run directly on conn are not seen by the cache
+                if self.cache is not None:
+                    self.cache.clear()
+
+    def executemany(self, query, rows, batch_size=10000):
+        """
+        Runs query once per row of rows, any iterable or generator, committing
+        once per batch_size rows. Returns the number of rows affected.
+        """
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            with self.transaction() as conn:
+                count += conn.executemany(query, batch).rowcount
+        if self.cache is not None:
+            self.cache.invalidate_query(query)
+        return count
+
+    def insert_unique(self, table_name, id_name, values, new_id, attempts=5):
+        """
+        Inserts values into table_name with id_name set to new_id(), calling it
+        again if the id violates the column's UNIQUE constraint. Returns the id.
+        """
+        columns = [id_name] + list(values)
+        query = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, ', '.join(columns),
+                                                          ', '.join('?' * len(columns)))
+        conflict = '{}.{}'.format(table_name, id_name)
+        error = None
+        for _ in range(attempts):
+            uid = new_id()
+            try:
+                with self.transaction() as conn:
+                    conn.execute(query, [uid] + list(values.values()))
+                return uid
+            except sqlite3.IntegrityError as e:
+                if conflict not in str(e):
+                    raise
+                error = e
+        raise error
+
+    def executescript(self, script):
+        """
+        Runs a script of several statements as one transaction. The script should
+        not begin or commit transactions itself.
+        """
+        conn = self.connection()
+        with self.locked():
+            if conn.in_transaction:
+                conn.commit()
+            try:
+                conn.executescript('BEGIN;\n{}\n;COMMIT;'.format(script))
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                if self.cache is not None:
+                    self.cache.clear()
+
+    def create_function(self, name, parameters, callback):
+        with self._lock:
+            self._functions.append((name, parameters, callback))
+            for thread, conn in self._connections:
+                conn.create_function(name, parameters, callback)
+
+    def close(self):
+        """Commits and closes every connection the pool has opened."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for thread, conn in connections:
+            conn.commit()
+            conn.close()
+        self._local = threading.local()
+
+
+class AstatineQueryCache(object):
+    """
+    LRU cache of SELECT results keyed on query text and values.
+
+    Each entry is indexed under every word of its query, which covers every
+    table it reads from, and a write statement drops the entries indexed under
+    the table it writes to. Writes made by triggers, or reads through views,
+    are not tracked, use a ttl or clear() for those.
+    """
+
+    _write_table = re.compile(r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|'
+                              r'DELETE\s+FROM|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE)\s+'
+                              r'(?:\w+\.)?[\["`]?(\w+)', re.IGNORECASE)
+    _words = re.compile(r'\w+')
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_read(query):
+        return query.lstrip()[:6].upper() == 'SELECT'
+
+    @staticmethod
+    def _key(query, values, fetchall):
+        """Returns None for values that cannot be hashed, those queries are not cached."""
+        if not values:
+            values = ()
+        elif isinstance(values, dict):
+            # named parameters, tuple() alone would only keep the names
+            values = tuple(sorted(values.items()))
+        else:
+            values = tuple(values)
+        key = (query, values, fetchall)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, query, values=None, fetchall=True):
+        """Returns (True, result) on a hit and (False, None) on a miss."""
+        key = self._key(query, values, fetchall)
+        if key is None:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            result = entry[2]
+        return True, list(result) if isinstance(result, list) else result
+
+    def put(self, query, values, fetchall, result, generation):
+        """Stores a result, unless a write has happened since generation was read."""
+        key = self._key(query, values, fetchall)
+        if key is None:
+            return
+        words = {word.lower() for word in self._words.findall(query)}
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (expires, words, list(result) if isinstance(result, list) else result)
+            for word in words:
+                self._tables.setdefault(word, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for word in entry[1]:
+            keys = self._tables.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[word]
+
+    def invalidate(self, table):
+        """Drops every cached result that reads from table."""
+        with self._lock:
+            self.generation += 1
+            for key in list(self._tables.get(table.lower(), ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_query(self, query):
+        """Drops the results a write statement may have changed, or everything if its table is unknown."""
+        match = self._write_table.match(query)
+        if match:
+            self.invalidate(match.group(1))
+        else:
+            self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tables.clear()
+
+    def stats(self):
+        """
+        :return: A dict of hits, misses, evictions, invalidations and the current size.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'size': len(self._entries)}
+
+
+class AstatineUID(object):
+    """
+    Random ids drawn from os.urandom, generated pool_size at a time so that
+    handing one out is a list pop. The alphabet must be ASCII and at most 256
+    characters; bytes that would bias the distribution are discarded.
+    """
+
+    def __init__(self, alphabet=string.digits + string.ascii_letters, length=20, pool_size=1024):
+        if not 0 < len(alphabet) <= 256 or not alphabet.isascii():
+            raise ValueError('The uid alphabet must be 1 to 256 ASCII characters')
+        self.alphabet = alphabet
+        self.length = length
+        self.pool_size = pool_size
+        limit = 256 - 256 % len(alphabet)
+        self._table = bytes(ord(alphabet[b % len(alphabet)]) if b < limit else 0 for b in range(256))
+        self._reject = bytes(range(limit, 256))
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Drops the pooled ids, a forked process must not hand out the same ones as its parent."""
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def generate(self, count, length=None):
+        """
+        :param count: How many ids to generate.
+        :param length: The id length, defaults to self.length.
+        :return: A list of count new ids.
+        """
+        length = length or self.length
+        needed = count * length
+        chars = b''
+        while len(chars) < needed:
+            # translate maps each byte to a character in C, rejected bytes are deleted
+            chars += secrets.token_bytes(needed - len(chars) + 16).translate(self._table, self._reject)
+        text = chars[:needed].decode('ascii')
+        return [text[i:i + length] for i in range(0, needed, length)]
+
+    def next(self, length=None):
+        """Returns one id from the pre-generated pool for length, refilling it when empty."""
+        length = length or self.length
+        with self._lock:
+            pool = self._pools.get(length)
+            if not pool:
+                pool = self._pools[length] = self.generate(self.pool_size, length)
+            return pool.pop()
 
 
 class AstatineAES(object):
-    """ Astatine Encryption and Decryption Class """
+    """
+    Astatine Encryption and Decryption Class
+
+    encrypt and decrypt handle short strings with AES-CBC, encrypt_many and decrypt_many do
+    the same for a whole list at once. Files and streams are encrypted in chunks with AES-GCM,
+    see AstatineAESWriter, so they never have to fit in memory.
+    """
 
     def __init__(self, key):
         if not aes_disabled:
@@ -445,10 +2141,10 @@ class AstatineAES(object):
             """)
 
     def encrypt(self, raw):
-        raw = self._pad(raw)
+        raw = self._pad(raw.encode())
         iv = Random.new().read(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw.encode()))
+        return base64.b64encode(iv + cipher.encrypt(raw))
 
     def decrypt(self, enc):
         # print(enc)
@@ -458,37 +2154,741 @@ class AstatineAES(object):
         return self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
 
     def _pad(self, s):
-        return s + (self.bs - len(s) % self.bs) * chr(self.bs - len(s) % self.bs)
+        return s + (self.bs - len(s) % self.bs) * bytes([self.bs - len(s) % self.bs])
 
     @staticmethod
     def _unpad(s):
         return s[:-ord(s[len(s) - 1:])]
 
+    def encrypt_many(self, values):
+        """
+        Encrypts a list of strings like encrypt, with a single AES key schedule. Block n of every
+        value is chained and encrypted in one call, so the number of calls is the block count of
+        the longest value rather than the number of values.
+        :return: A list of base64 encoded values that decrypt and decrypt_many accept.
+        """
+        bs = self.bs
+        ecb = AES.new(self.key, AES.MODE_ECB)
+        padded = [self._pad(value.encode()) for value in values]
+        randomness = Random.new().read(bs * len(padded))
+        previous = [randomness[i * bs:(i + 1) * bs] for i in range(len(padded))]
+        out = [[block] for block in previous]
+        index = 0
+        while True:
+            pending = [i for i, value in enumerate(padded) if len(value) > index]
+            if not pending:
+                break
+            chained = b''.join((int.from_bytes(padded[i][index:index + bs], 'big')
+                                ^ int.from_bytes(previous[i], 'big')).to_bytes(bs, 'big') for i in pending)
+            encrypted = ecb.encrypt(chained)
+            for n, i in enumerate(pending):
+                previous[i] = encrypted[n * bs:(n + 1) * bs]
+                out[i].append(previous[i])
+            index += bs
+        return [base64.b64encode(b''.join(blocks)) for blocks in out]
+
+    def decrypt_many(self, values):
+        """
+        Decrypts a list of values from encrypt or encrypt_many with a single AES call.
+        :return: A list of strings.
+        """
+        bs = self.bs
+        raw = [base64.b64decode(value) for value in values]
+        decrypted = AES.new(self.key, AES.MODE_ECB).decrypt(b''.join(value[bs:] for value in raw))
+        result = []
+        offset = 0
+        for value in raw:
+            size = len(value) - bs
+            plain = int.from_bytes(decrypted[offset:offset + size], 'big') ^ int.from_bytes(value[:size], 'big')
+            result.append(self._unpad(plain.to_bytes(size, 'big')).decode('utf-8'))
+            offset += size
+        return result
+
+    def writer(self, dst, chunk_size=65536):
+        """:return: An AstatineAESWriter encrypting into the binary file-like object dst."""
+        return AstatineAESWriter(self.key, dst, chunk_size)
+
+    def iter_decrypt(self, src):
+        """
+        Reads a stream written by AstatineAESWriter from the binary file-like object src.
+        :return: A generator of decrypted chunks. It raises ValueError once a chunk fails
+            authentication or the stream is cut short, so whatever was decrypted before
+            has to be thrown away.
+        """
+        header = src.read(AstatineAESWriter.header_size)
+        chunk_size, nonce_prefix = AstatineAESWriter.parse_header(header)
+        tag_size = AstatineAESWriter.tag_size
+        counter = 0
+        chunk = src.read(chunk_size + tag_size)
+        while True:
+            following = src.read(chunk_size + tag_size) if len(chunk) == chunk_size + tag_size else b''
+            final = not following
+            if len(chunk) < tag_size:
+                raise ValueError('Encrypted stream is truncated')
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce_prefix + counter.to_bytes(4, 'big'))
+            cipher.update(header + (b'\x01' if final else b'\x00'))
+            yield cipher.decrypt_and_verify(chunk[:-tag_size], chunk[-tag_size:])
+            if final:
+                return
+            chunk = following
+            counter += 1
+
+    def encrypt_stream(self, src, dst, chunk_size=65536):
+        """
+        Encrypts the binary file-like object src into dst.
+        :return: The number of bytes encrypted.
+        """
+        size = 0
+        with self.writer(dst, chunk_size) as out:
+            data = src.read(chunk_size)
+            while data:
+                size += len(data)
+                out.write(data)
+                data = src.read(chunk_size)
+        return size
+
+    def decrypt_stream(self, src, dst):
+        """
+        Decrypts the binary file-like object src into dst, see iter_decrypt.
+        :return: The number of bytes decrypted.
+        """
+        size = 0
+        for chunk in self.iter_decrypt(src):
+            size += len(chunk)
+            dst.write(chunk)
+        return size
+
+    def _convert_file(self, convert, path, dest):
+        dest = dest or path
+        temp_path = os.path.join(os.path.dirname(dest), '.aes-{}'.format(secrets.token_hex(8)))
+        try:
+            with open(path, 'rb') as src, open(temp_path, 'xb') as dst:
+                size = convert(src, dst)
+            os.replace(temp_path, dest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return size
+
+    def encrypt_file(self, path, dest=None, chunk_size=65536):
+        """
+        Encrypts a file into dest, or in place, through a temporary file that replaces dest once complete.
+        :return: The number of bytes encrypted.
+        """
+        return self._convert_file(lambda src, dst: self.encrypt_stream(src, dst, chunk_size), path, dest)
+
+    def decrypt_file(self, path, dest=None):
+        """
+        Decrypts a file into dest, or in place, dest is left untouched if the file fails authentication.
+        :return: The number of bytes decrypted.
+        """
+        return self._convert_file(self.decrypt_stream, path, dest)
+
+    @staticmethod
+    def plaintext_size(path):
+        """:return: The size of a file written by AstatineAESWriter once it is decrypted."""
+        with open(path, 'rb') as f:
+            chunk_size, nonce_prefix = AstatineAESWriter.parse_header(f.read(AstatineAESWriter.header_size))
+        body = os.path.getsize(path) - AstatineAESWriter.header_size
+        chunks = max(1, -(-body // (chunk_size + AstatineAESWriter.tag_size)))
+        return body - chunks * AstatineAESWriter.tag_size
+
+
+class AstatineAESWriter(object):
+    """
+    File-like object encrypting what is written to it into dst, in chunks of chunk_size bytes.
+
+    The stream starts with a header of a magic string, the chunk size and a random nonce
+    prefix. Every chunk is then encrypted with AES-GCM under the nonce prefix and the chunk
+    number, and followed by its tag. The header, and whether the chunk is the last one, are
+    authenticated with every chunk, so chunks can be neither reordered nor dropped. close
+    writes the last chunk, possibly empty, and must be called, it does not close dst.
+    """
+
+    magic = b'AST1'
+    header_size = 16
+    tag_size = 16
+
+    def __init__(self, key, dst, chunk_size=65536):
+        self.key = key
+        self.dst = dst
+        self.chunk_size = chunk_size
+        self.header = self.magic + chunk_size.to_bytes(4, 'big') + Random.new().read(8)
+        self._nonce_prefix = self.header[8:]
+        self._counter = 0
+        self._buffer = bytearray()
+        self.closed = False
+        dst.write(self.header)
+
+    @classmethod
+    def parse_header(cls, header):
+        """:return: The chunk size and nonce prefix of a stream header, ValueError if it is not one."""
+        if len(header) != cls.header_size or header[:4] != cls.magic:
+            raise ValueError('Not an AstatineAES stream')
+        return int.from_bytes(header[4:8], 'big'), header[8:]
+
+    def _write_chunk(self, data, final):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=self._nonce_prefix + self._counter.to_bytes(4, 'big'))
+        cipher.update(self.header + (b'\x01' if final else b'\x00'))
+        encrypted, tag = cipher.encrypt_and_digest(data)
+        self.dst.write(encrypted)
+        self.dst.write(tag)
+        self._counter += 1
+
+    def write(self, data):
+        self._buffer += data
+        # a full chunk is only written once more data follows, the last chunk is written by close
+        while len(self._buffer) > self.chunk_size:
+            self._write_chunk(bytes(self._buffer[:self.chunk_size]), False)
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._write_chunk(bytes(self._buffer), True)
+            self._buffer = bytearray()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
 
 class AstatineSMTP(object):
-    """ Astatine Email Class """
+    """
+    Astatine Email Class
+
+    Without a host, emails are sent synchronously with the mail command. With a host,
+    send_email only queues the email and AstatineMailQueue worker threads deliver it
+    over persistent SMTP connections, see AstatineMailQueue for the other options.
+    """
 
-    def __init__(self, sender):
+    def __init__(self, sender, host=None, port=25, **queue_options):
         self.email_to = None
         self.sender = sender
+        self.queue = AstatineMailQueue(host, port, **queue_options) if host else None
 
     def send_email(self, receiver, subject, content=None):
+        if self.queue:
+            self.queue.put(self.sender, receiver, subject, content)
+            return
         subprocess.run(['mail', '--content-type=text/html', '-s', subject, '-r', self.sender, receiver,], input=content, text=True)
 
+    def close(self, timeout=None):
+        """Delivers whatever is due and stops the queue's worker threads."""
+        if self.queue:
+            self.queue.close(timeout)
+
     def set_sender(self, sender):
         self.sender = sender
 
 
+class AstatineMailQueue(object):
+    """
+    Background email delivery.
+
+    Worker threads each keep one SMTP connection open and send up to batch_size due
+    emails over it at a time. A failed email is retried max_retries times, waiting
+    retry_delay * 2 ** attempt seconds between tries. With a path, pending emails are
+    also kept in a SQLite table and sent after a restart.
+
+    Threads and SQLite connections do not survive a fork, so a queue created before
+    run_astatine(workers=...) starts its own threads and connection in a worker process
+    on that worker's first put. Emails left in the table from before the start are only
+    loaded by the process that created the queue.
+    """
+
+    def __init__(self, host, port=25, username=None, password=None, starttls=False, workers=1, batch_size=20,
+                 max_retries=5, retry_delay=2, timeout=30, keepalive=60, path=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.sent = 0
+        self.failed = 0
+        self.path = path
+        self.worker_count = workers
+        self._sequence = itertools.count()
+        self._start_lock = threading.Lock()
+        self._start(load=True)
+
+    def _start(self, load):
+        """Starts the worker threads, and opens the SQLite table, for the current process."""
+        self._pid = os.getpid()
+        self._heap = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        # a connection inherited from the parent process must not be used, nor closed, here
+        self._db = None
+        self._db_lock = threading.Lock()
+        if self.path:
+            self._setup_db(self.path, load)
+        self._workers = [threading.Thread(target=self._work, name='astatine-mail-{}'.format(i), daemon=True)
+                         for i in range(self.worker_count)]
+        for worker in self._workers:
+            worker.start()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start(load=False)
+
+    def _setup_db(self, path, load=True):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS mail_queue (
+                id INTEGER PRIMARY KEY,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                content TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_try REAL NOT NULL
+            )
+        ''')
+        self._db.commit()
+        if not load:
+            return
+        for row in self._db.execute('SELECT id, sender, receiver, subject, content, attempts, next_try FROM mail_queue'):
+            mail = dict(zip(('id', 'sender', 'receiver', 'subject', 'content', 'attempts'), row[:6]))
+            heapq.heappush(self._heap, (row[6], next(self._sequence), mail))
+
+    def _persist(self, query, values):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row_id = self._db.execute(query, values).lastrowid
+            self._db.commit()
+        return row_id
+
+    def put(self, sender, receiver, subject, content=None):
+        """Queues an email, it is sent by a worker thread. Raises ValueError for invalid headers."""
+        mail = {'sender': sender, 'receiver': receiver, 'subject': subject, 'content': content, 'attempts': 0}
+        # e.g. a subject with a line break, better refused here than by the worker
+        self._message(mail)
+        self._check_process()
+        now = time.time()
+        mail['id'] = self._persist('''
+            INSERT INTO mail_queue (sender, receiver, subject, content, next_try) VALUES (?,?,?,?,?)
+        ''', (sender, receiver, subject, content, now))
+        with self._cond:
+            heapq.heappush(self._heap, (now, next(self._sequence), mail))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    batch = []
+                    while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                        batch.append(heapq.heappop(self._heap)[2])
+                    return batch
+                if self._stopped:
+                    # emails waiting for a retry stay in the SQLite table, if there is one
+                    return []
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    @staticmethod
+    def _message(mail):
+        message = email.message.EmailMessage()
+        message['From'] = mail['sender']
+        message['To'] = mail['receiver']
+        message['Subject'] = mail['subject']
+        message.set_content(mail['content'] or '', subtype='html')
+        return message
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        return smtp
+
+    @staticmethod
+    def _disconnect(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _retry(self, mail, error):
+        mail['attempts'] += 1
+        if mail['attempts'] > self.max_retries:
+            self.failed += 1
+            print('Error: could not send email to {}: {}'.format(mail['receiver'], error))
+            self._persist('DELETE FROM mail_queue WHERE id = ?', (mail['id'],))
+            return
+        next_try = time.time() + self.retry_delay * 2 ** (mail['attempts'] - 1)
+        self._persist('UPDATE mail_queue SET attempts = ?, next_try = ? WHERE id = ?',
+                      (mail['attempts'], next_try, mail['id']))
+        with self._cond:
+            heapq.heappush(self._heap, (next_try, next(self._sequence), mail))
+            self._cond.notify()
+
+    def _work(self):
+        smtp, last_used = None, 0
+        while True:
+            batch = self._take()
+            if not batch:
+                break
+            for mail in batch:
+                try:
+                    if smtp is not None and time.time() - last_used > self.keepalive:
+                        try:
+                            smtp.noop()
+                        except (smtplib.SMTPException, OSError):
+                            smtp.close()
+                            smtp = None
+                    message = self._message(mail)
+                    if smtp is None:
+                        smtp = self._connect()
+                    smtp.send_message(message)
+                    last_used = time.time()
+                    self.sent += 1
+                    self._persist('DELETE FROM mail_queue WHERE id = ?', (mail['id'],))
+                except (smtplib.SMTPException, OSError) as e:
+                    if smtp is not None and not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        smtp.close()
+                        smtp = None
+                    self._retry(mail, e)
+                except Exception as e:
+                    # retrying cannot help an email that cannot be built, e.g. loaded from an older queue
+                    self.failed += 1
+                    print('Error: could not send email to {}: {}'.format(mail['receiver'], e))
+                    self._persist('DELETE FROM mail_queue WHERE id = ?', (mail['id'],))
+        if smtp is not None:
+            self._disconnect(smtp)
+
+    def close(self, timeout=None):
+        """Sends every email that is due, then stops the workers and closes their connections."""
+        if self._pid != os.getpid():
+            # nothing was started in this process
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+
 class AstatineJSON(object):
-    """ Astatine JSON Class """
+    """
+    Astatine JSON Class
+
+    The document is kept in memory and only parsed again when the file's mtime or size
+    changes. Writes go to a temporary file that replaces the original, so readers never
+    see half a document. With write_delay, writes are held back that many seconds and a
+    burst of updates ends up as a single write.
+    """
 
-    def __init__(self, file):
+    def __init__(self, file, write_delay=None):
         self.file = file
+        self.write_delay = write_delay
+        self._data = None
+        self._signature = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def _stat(self):
+        stat = os.stat(self.file)
+        return stat.st_mtime_ns, stat.st_size
 
     def read(self):
-        with open(self.file) as f:
-            return json.load(f)
+        """
+        :return: The cached document, shared between callers so it must not be modified,
+                 use update or write instead.
+        """
+        with self._lock:
+            if self._dirty:
+                return self._data
+            signature = self._stat()
+            if signature != self._signature:
+                with open(self.file) as f:
+                    self._data = json.load(f)
+                self._signature = signature
+            return self._data
+
+    def get(self, keys, default=None):
+        """
+        :param keys: A key, or a list of keys leading to a nested value.
+        :param default: Returned when one of the keys is missing.
+        """
+        value = self.read()
+        for key in [keys] if isinstance(keys, str) else keys:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+        return value
 
     def write(self, data):
-        with open(self.file) as f:
-            json.dump(data, f)
\ No newline at end of file
+        with self._lock:
+            self._data = data
+            self._dirty = True
+            self._schedule()
+
+    def update(self, keys, value):
+        """
+        Sets a nested value, creating missing dicts on the way.
+
+        :param keys: A key, or a list of keys leading to the value.
+        :param value: The new value.
+        """
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        with self._lock:
+            try:
+                data = self.read()
+            except FileNotFoundError:
+                data = {}
+            # copy the path down to the value, readers may still hold the old document
+            data = dict(data)
+            parent = data
+            for key in keys[:-1]:
+                child = parent.get(key)
+                parent[key] = child = dict(child) if isinstance(child, dict) else {}
+                parent = child
+            parent[keys[-1]] = value
+            self.write(data)
+
+    def _schedule(self):
+        if self.write_delay is None:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.write_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes the pending document, if there is one."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            temp_path = os.path.join(os.path.dirname(self.file), '.json-{}'.format(secrets.token_hex(8)))
+            try:
+                with open(temp_path, 'x') as f:
+                    json.dump(self._data, f)
+                os.replace(temp_path, self.file)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            self._signature = self._stat()
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+
+
+class AstatineWorkerServer(socketserver.ThreadingMixIn, WSGIServer):
+    """ Threaded wsgiref server for a prefork worker, serving on an already listening socket """
+
+    block_on_close = True
+
+    def __init__(self, sock, app, quiet=False):
+        WSGIServer.__init__(self, sock.getsockname()[:2], AstatineQuietHandler if quiet else WSGIRequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name, self.server_port = sock.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self.timeout = 1
+        self.handled = 0
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+
+class AstatineQuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AstatineVisitorCounter(threading.Thread):
+    """
+    Accumulates visits, unique visits and referrals per day in memory and writes
+    them to site_data.db in a single transaction, every flush_interval seconds or
+    once flush_size visits are pending, whichever comes first. on_flush is called
+    after every timed flush, prefork workers use it to reload the ban list.
+    """
+
+    periods = ('day', 'week', 'month')
+
+    def __init__(self, db, lock, flush_interval=5, flush_size=1000, on_flush=None):
+        threading.Thread.__init__(self, name='astatine-visitor-counter', daemon=True)
+        self._db = db
+        self._db_lock = lock
+        self.on_flush = on_flush
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._visits = {}
+        self._unique = {}
+        self._referrals = {}
+        self._pending = 0
+
+    def add(self, day, unique=False, referral=None):
+        """
+        :param day: Timestamp of the start of the day.
+        :param unique: Whether this is the visitor's first visit.
+        :param referral: The external referrer, if any.
+        """
+        with self._lock:
+            self._visits[day] = self._visits.get(day, 0) + 1
+            if unique:
+                self._unique[day] = self._unique.get(day, 0) + 1
+            if referral:
+                self._referrals[(day, referral)] = self._referrals.get((day, referral), 0) + 1
+            self._pending += 1
+            full = self._pending >= self.flush_size
+        if full:
+            # on the request thread, a failed write must not turn the visit into an error page
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print('Error: could not write visitor counts: {}'.format(e))
+
+    def flush(self):
+        """
+        Writes all pending counts in one transaction. If it fails, e.g. because another process holds
+        the database lock, it is rolled back and the counts are kept for the next flush.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            visits, unique, referrals = self._visits, self._unique, self._referrals
+            self._visits, self._unique, self._referrals, self._pending = {}, {}, {}, 0
+
+        with self._db_lock:
+            c = self._db.cursor()
+            try:
+                self._write(c, visits, unique, referrals)
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                self._restore(visits, unique, referrals)
+                raise
+            finally:
+                c.close()
+
+    def _restore(self, visits, unique, referrals):
+        """Adds counts that could not be written back to the pending ones."""
+        with self._lock:
+            for pending, counts in ((self._visits, visits), (self._unique, unique), (self._referrals, referrals)):
+                for key, count in counts.items():
+                    pending[key] = pending.get(key, 0) + count
+            self._pending += sum(visits.values())
+
+    def _write(self, c, visits, unique, referrals):
+        c.executemany('''
+            INSERT INTO visitors (datetime, visits) VALUES (?,?)
+            ON CONFLICT (datetime) DO UPDATE SET visits = visits + excluded.visits
+        ''', visits.items())
+        c.executemany('''
+            INSERT INTO unique_visitors (datetime, visits) VALUES (?,?)
+            ON CONFLICT (datetime) DO UPDATE SET visits = visits + excluded.visits
+        ''', unique.items())
+        c.executemany('''
+            INSERT INTO visitor_referral (datetime, referral, visits) VALUES (?,?,?)
+            ON CONFLICT (datetime, referral) DO UPDATE SET visits = visits + excluded.visits
+        ''', ((day, referral, count) for (day, referral), count in referrals.items()))
+        self.write_rollups(c, visits, unique, referrals)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def period_start(day, period):
+        """
+        :param day: Timestamp of the start of a day.
+        :param period: 'day', 'week' or 'month'.
+        :return: Timestamp of the start of the week (monday) or month day is in.
+        """
+        if period == 'day':
+            return day
+        date = datetime.date.fromtimestamp(day)
+        if period == 'week':
+            date -= datetime.timedelta(days=date.weekday())
+        elif period == 'month':
+            date = date.replace(day=1)
+        else:
+            raise ValueError('Unknown period "{}"'.format(period))
+        return int(datetime.datetime.combine(date, datetime.time.min).timestamp())
+
+    @classmethod
+    def period_range(cls, start, end, period):
+        """Turns a range of dates, datetimes or timestamps into the first and last period start it covers."""
+        days = []
+        for value in (start, end):
+            if isinstance(value, (int, float)):
+                value = datetime.datetime.fromtimestamp(value)
+            if isinstance(value, datetime.datetime):
+                value = value.date()
+            days.append(int(datetime.datetime.combine(value, datetime.time.min).timestamp()))
+        return cls.period_start(days[0], period), cls.period_start(days[1], period)
+
+    @classmethod
+    def write_rollups(cls, c, visits, unique, referrals):
+        """Adds daily counts to the day, week and month rows of visitor_rollup and referral_rollup."""
+        totals = {}
+        for column, counts in ((0, visits), (1, unique)):
+            for day, count in counts.items():
+                for period in cls.periods:
+                    total = totals.setdefault((period, cls.period_start(day, period)), [0, 0])
+                    total[column] += count
+        c.executemany('''
+            INSERT INTO visitor_rollup (period, start, visits, unique_visits) VALUES (?,?,?,?)
+            ON CONFLICT (period, start) DO UPDATE SET
+                visits = visits + excluded.visits, unique_visits = unique_visits + excluded.unique_visits
+        ''', ((period, start, total[0], total[1]) for (period, start), total in totals.items()))
+
+        referral_totals = {}
+        for (day, referral), count in referrals.items():
+            for period in cls.periods:
+                key = (period, cls.period_start(day, period), referral)
+                referral_totals[key] = referral_totals.get(key, 0) + count
+        c.executemany('''
+            INSERT INTO referral_rollup (period, start, referral, visits) VALUES (?,?,?,?)
+            ON CONFLICT (period, start, referral) DO UPDATE SET visits = visits + excluded.visits
+        ''', ((period, start, referral, count) for (period, start, referral), count in referral_totals.items()))
+
+    def run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print('Error: could not write visitor counts: {}'.format(e))
+            if self.on_flush:
+                try:
+                    self.on_flush()
+                except sqlite3.Error as e:
+                    print('Error: visitor counter on_flush failed: {}'.format(e))
+
+    def stop(self):
+        """Stops the flush thread and writes whatever is still pending."""
+        self._stopped.set()
+        self.flush()
@@ -0,0 +1,308 @@
+"""
+Benchmarks for astatine.
+
+    python astatine_bench.py [--number 2000] [--threads 8] [--json results.json]
+    python astatine_bench.py --static-routes
+
+The WSGI suite drives an Astatine app in-process, without a network or a server, through
+a bare route, a session route with and without a session cookie, track_visitor,
+execute_sql from several threads, a large upload saved with upload_files and a static
+file from /s/. Every scenario reports its throughput, p50/p99 latency and the peak
+memory traced while it runs. Results can be saved as JSON to compare two runs.
+
+Static route matching compares the old single regex route, one big alternation of
+every static extension, followed by the extension list search the old _static_files
+did, with the /s/<filepath:path> route and a dict lookup on the extension that astatine
+uses now, as the extension list grows. At astatine's own 30 extensions both cost about
+the same, and at 10 the regex is slightly faster. The regex cost grows with every
+extension added, so the dispatch only pays off from about 100 extensions. Its real
+gains are the constant cost and that extensions can be added without rebuilding the route.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+from bottle import Bottle, request
+
+from astatine import Astatine
+
+
+def _extensions(count):
+    base = sorted(Astatine._static_mimetype_overrides) + ['css', 'js', 'png', 'jpg', 'mp4', 'pdf']
+    return (base + ['x{}'.format(i) for i in range(count)])[:count]
+
+
+def _environ(path):
+    return {'PATH_INFO': path, 'REQUEST_METHOD': 'GET'}
+
+
+def bench_static_routes(counts=(10, 30, 100, 300, 1000), number=20000):
+    """
+    :param counts: The extension list sizes to measure.
+    :param number: How many matches are timed per measurement.
+    :return: A list of dicts with the per-match cost in microseconds of each approach.
+    """
+    results = []
+    for count in counts:
+        extensions = _extensions(count)
+        # the last extension is the worst case for the alternation
+        path = '/s/views/img/picture.{}'.format(extensions[-1])
+
+        regex_app = Bottle()
+        regex_app.route("/s/<filepath:re:.*\\.({})>".format("|".join(extensions)), callback=lambda filepath: None)
+        regex_match = regex_app.router.match
+        extension_list = list(extensions)
+
+        def regex(environ):
+            # the old _static_files also split off the extension and searched the extension list
+            route, args = regex_match(environ)
+            return os.path.splitext(args['filepath'])[1][1:] in extension_list
+
+        table = {ext: 'application/octet-stream' for ext in extensions}
+        dispatch_app = Bottle()
+        dispatch_app.route("/s/<filepath:path>", callback=lambda filepath: None)
+        dispatch_match = dispatch_app.router.match
+
+        def dispatch(environ):
+            route, args = dispatch_match(environ)
+            return table.get(os.path.splitext(args['filepath'])[1][1:].lower())
+
+        environ = _environ(path)
+        regex_cost = min(timeit.repeat(lambda: regex(environ), number=number, repeat=3)) / number
+        lookup = min(timeit.repeat(lambda: dispatch(environ), number=number, repeat=3)) / number
+        results.append({'extensions': count, 'regex_us': regex_cost * 1e6, 'dispatch_us': lookup * 1e6})
+    return results
+
+
+def wsgi_request(app, path, method='GET', body=b'', headers=None):
+    """
+    Calls a WSGI app directly and reads the whole response.
+    :param headers: Extra environ entries, e.g. {'HTTP_COOKIE': ...}.
+    :return: The status line, the response headers and the body.
+    """
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr}
+    setup_testing_defaults(environ)
+    if headers:
+        environ.update(headers)
+    started = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = response_headers
+
+    result = app(environ, start_response)
+    try:
+        data = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], data
+
+
+def _multipart(field, filename, size):
+    boundary = 'astatinebench'
+    head = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').format(boundary, field, filename).encode('ascii')
+    body = head + os.urandom(size) + '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+    return body, {'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(boundary)}
+
+
+def _session_cookie(headers):
+    for name, value in headers:
+        if name.lower() == 'set-cookie':
+            return value.split(';', 1)[0]
+    return None
+
+
+def _percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def measure(name, call, number, threads=1, memory_number=None):
+    """
+    Times call, number times in total, spread over threads threads.
+    :param memory_number: How many calls to trace with tracemalloc for the peak memory, tracing
+        slows every allocation down, so it is done in a separate, shorter pass.
+    :return: A dict with the throughput in requests/s, the p50/p99 latency in ms and the peak
+        traced memory in KiB.
+    """
+    per_thread = max(1, number // threads)
+    latencies = [[] for _ in range(threads)]
+
+    def run(times, out):
+        clock = time.perf_counter
+        for _ in range(times):
+            start = clock()
+            call()
+            out.append(clock() - start)
+
+    workers = [threading.Thread(target=run, args=(per_thread, latencies[i])) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        run(memory_number or min(per_thread, 100), [])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    flat = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    return {'scenario': name, 'requests': len(flat), 'threads': threads,
+            'throughput': len(flat) / elapsed,
+            'p50_ms': _percentile(flat, 0.50) * 1e3, 'p99_ms': _percentile(flat, 0.99) * 1e3,
+            'peak_kib': peak / 1024}
+
+
+@contextlib.contextmanager
+def bench_app(session_backend='file', directory=None):
+    """
+    Yields an Astatine app with the benchmark routes, running in a temporary directory since
+    Astatine creates its views/, sql/ and user_data/ directories in the working directory.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=directory) as root:
+        os.chdir(root)
+        os.makedirs('sql')
+        app = None
+        try:
+            app = Astatine(quiet=True, sql_name='sql/bench.db')
+            # keep file sessions in the temporary directory instead of the default /tmp
+            store_options = {'session_dir': os.path.join(root, 'sessions')} if session_backend == 'file' else {}
+            app.enable_sessions(backend=session_backend, **store_options)
+            app.executescript('''
+                CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+            ''')
+            app.executemany('INSERT INTO items (name) VALUES (?)', [('item {}'.format(i),) for i in range(1000)])
+            with open('views/css/bench.css', 'w') as f:
+                f.write('body { color: #333; }\n' * 3000)
+
+            def bare():
+                return 'ok'
+
+            def counter(session):
+                session['count'] = (session.get('count') or 0) + 1
+                return str(session['count'])
+
+            def visitor(session):
+                app.track_visitor(session, ['localhost'])
+                return 'ok'
+
+            def items():
+                return json.dumps(app.execute_sql('SELECT id, name FROM items WHERE id > ? LIMIT 20', (500,), cache=False))
+
+            def upload():
+                saved = app.upload_files(request.files.getall('upload'), '*', 'user_data/bench/', rename='upload')
+                return json.dumps(saved)
+
+            app.route('/bare', 'GET', bare)
+            app.route('/counter', 'GET', counter, sessions=True)
+            app.route('/visitor', 'GET', visitor, sessions=True)
+            app.route('/items', 'GET', items)
+            app.route('/upload', 'POST', upload)
+            yield app
+        finally:
+            if app is not None:
+                app._close_resources()
+            os.chdir(cwd)
+
+
+def bench_wsgi(number=2000, threads=8, upload_size=8388608, session_backend='file', scenarios=None):
+    """
+    :param number: Requests per scenario, the upload scenario makes number // 100 of them.
+    :param threads: Threads making execute_sql requests at the same time.
+    :param upload_size: Bytes per uploaded file.
+    :param session_backend: The backend passed to enable_sessions.
+    :param scenarios: Names of the scenarios to run, all of them by default.
+    :return: A list of result dicts, see measure.
+    """
+    results = []
+    with bench_app(session_backend) as astatine:
+        app = astatine.app
+        warm_cookie = _session_cookie(wsgi_request(app, '/counter')[1])
+        body, upload_headers = _multipart('upload', 'bench.bin', upload_size)
+        wsgi_request(app, '/s/views/css/bench.css')
+
+        suite = [
+            ('bare_route', lambda: wsgi_request(app, '/bare'), 1, number),
+            ('session_cold', lambda: wsgi_request(app, '/counter'), 1, number),
+            ('session_warm', lambda: wsgi_request(app, '/counter', headers={'HTTP_COOKIE': warm_cookie}), 1, number),
+            ('track_visitor', lambda: wsgi_request(app, '/visitor', headers={
+                'HTTP_COOKIE': warm_cookie, 'HTTP_REFERER': 'https://example.com/'}), 1, number),
+            ('execute_sql', lambda: wsgi_request(app, '/items'), threads, number),
+            ('upload_files', lambda: wsgi_request(app, '/upload', 'POST', body, upload_headers), 1,
+             max(1, number // 100)),
+            ('static_file', lambda: wsgi_request(app, '/s/views/css/bench.css'), 1, number),
+        ]
+        for name, call, thread_count, count in suite:
+            if scenarios and name not in scenarios:
+                continue
+            status = call()[0]
+            if not status.startswith('200'):
+                raise RuntimeError('{} answered {}'.format(name, status))
+            results.append(measure(name, call, count, thread_count, memory_number=min(count, 100)))
+    return results
+
+
+def save_results(path, results, **options):
+    """Writes the results as JSON, along with the versions and options they were measured with."""
+    document = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'bottle': bottle.__version__,
+        'options': options,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Astatine benchmarks')
+    parser.add_argument('--number', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=8, help='threads for the execute_sql scenario')
+    parser.add_argument('--upload-size', type=int, default=8388608, help='bytes per uploaded file')
+    parser.add_argument('--session-backend', default='file', choices=['file', 'memory', 'sqlite'])
+    parser.add_argument('--scenario', action='append', help='only run this scenario, can be repeated')
+    parser.add_argument('--json', help='also save the results to this file')
+    parser.add_argument('--static-routes', action='store_true', help='compare static route matching instead')
+    args = parser.parse_args(argv)
+
+    if args.static_routes:
+        print('{:>10} {:>12} {:>12}'.format('extensions', 'regex (us)', 'dispatch (us)'))
+        for result in bench_static_routes():
+            print('{extensions:>10} {regex_us:>12.2f} {dispatch_us:>12.2f}'.format(**result))
+        return
+
+    options = {'number': args.number, 'threads': args.threads, 'upload_size': args.upload_size,
+               'session_backend': args.session_backend}
+    results = bench_wsgi(scenarios=args.scenario, **options)
+    print('{:<14} {:>8} {:>8} {:>12} {:>10} {:>10} {:>10}'.format(
+        'scenario', 'requests', 'threads', 'requests/s', 'p50 (ms)', 'p99 (ms)', 'peak (KiB)'))
+    for result in results:
+        print('{scenario:<14} {requests:>8} {threads:>8} {throughput:>12.1f} {p50_ms:>10.3f} {p99_ms:>10.3f} '
+              '{peak_kib:>10.1f}'.format(**result))
+    if args.json:
+        save_results(args.json, results, **options)
+
+
+if __name__ == '__main__':
+    main()
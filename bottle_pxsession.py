@@ -3,6 +3,20 @@ CHANGES (Simon Harrison 2018-03-26):
 secret_key has been removed and pickle replaced with json.
 session['some key'] = 'some value' -- saves the new session
 
+CHANGES:
+SessionPlugin(write_behind=True) -- sessions are marked dirty on assignment and
+written once at the end of the request instead of on every key assignment.
+SessionPlugin(store=...) -- session data is kept in a SessionStore; file (default),
+in-memory LRU and SQLite (WAL) stores are provided, see create_store().
+SessionPlugin(lazy=True) -- sessions are loaded on first use, and a new session is
+only stored and given a cookie once something is written to it.
+SessionPlugin(secret=...) -- session data is kept in a signed (and, given a cipher,
+encrypted) cookie; payloads over max_cookie_size fall back to the store.
+SessionPlugin(sweep_interval=60) -- a background thread deletes expired sessions
+in batches. FileSessionStore(shard_depth=1) spreads files over subdirectories.
+SessionPlugin(observe=...) -- called with ('session_load', seconds) and
+('session_save', seconds) to time session I/O, e.g. by astatine's metrics.
+
 -- Adapted from below:
 
 https://github.com/promek/bottle-pxsession
@@ -33,9 +47,15 @@ __version__ = '0.1.0'
 __license__ = 'MIT'
 
 
-from bottle import PluginError, request, response
+from bottle import HTTPResponse, PluginError, request, response
+from collections import OrderedDict
+import base64
+import hashlib
+import hmac
 import inspect
 import json
+import sqlite3
+import threading
 import uuid
 import os
 import time
@@ -47,13 +67,299 @@ def getUuid():
 MAX_TTL = 14*24*3600 # 14 day maximum cookie limit for sessions
 
 
+class SessionStore(object):
+    """
+    Base class for session storage backends.
+
+    A store maps a session id to the session's data dictionary. Subclasses
+    implement load, save and delete; close is called when the plugin is closed.
+    """
+
+    def load(self, sessionid):
+        """Returns the stored data for sessionid, or None if there is none."""
+        raise NotImplementedError
+
+    def save(self, sessionid, data):
+        raise NotImplementedError
+
+    def delete(self, sessionid):
+        raise NotImplementedError
+
+    def sweep(self, before, limit=1000):
+        """
+        Deletes up to limit sessions that were last written before the timestamp
+        before, and returns how many were deleted.
+        """
+        return 0
+
+    def close(self):
+        pass
+
+    def reopen(self):
+        """Reopens any resources closed by close, e.g. in a worker process after a fork."""
+        pass
+
+
+class FileSessionStore(SessionStore):
+    """
+    One JSON file per session, the original pxsession layout.
+
+    With shard_depth set, files are spread over nested sess-px-<xx>
+    subdirectories chosen from a hash of the session id, so no single
+    directory grows without bound. Files in the flat layout are still read.
+    """
+
+    def __init__(self, session_dir="/tmp", shard_depth=0):
+        self.session_dir = session_dir
+        self.shard_depth = shard_depth
+        self._sweep_iter = None
+
+    def legacy_path(self, sessionid):
+        return os.path.join(self.session_dir, 'sess-px-%s' % sessionid)
+
+    def path(self, sessionid):
+        if not self.shard_depth:
+            return self.legacy_path(sessionid)
+        digest = hashlib.sha1(sessionid.encode('ascii')).hexdigest()
+        shards = ['sess-px-%s' % digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.session_dir, *shards, 'sess-px-%s' % sessionid)
+
+    def load(self, sessionid):
+        paths = [self.path(sessionid)]
+        if self.shard_depth:
+            paths.append(self.legacy_path(sessionid))
+        for fileName in paths:
+            try:
+                with open(fileName, 'r') as fp:
+                    return json.load(fp)
+            except (IOError, ValueError):
+                continue
+        return None
+
+    def save(self, sessionid, data):
+        fileName = self.path(sessionid)
+        try:
+            fp = open(fileName, 'w')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            fp = open(fileName, 'w')
+        with fp:
+            json.dump(data, fp)
+
+    def delete(self, sessionid):
+        for fileName in {self.path(sessionid), self.legacy_path(sessionid)}:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def _session_files(self):
+        dirs = [self.session_dir]
+        while dirs:
+            directory = dirs.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if not entry.name.startswith('sess-px-'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        yield entry
+
+    def sweep(self, before, limit=1000):
+        # carries on from where the previous sweep stopped, one directory at a time
+        removed = 0
+        for _ in range(limit):
+            if self._sweep_iter is None:
+                self._sweep_iter = self._session_files()
+            entry = next(self._sweep_iter, None)
+            if entry is None:
+                self._sweep_iter = None
+                break
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < before:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Bounded in-process store, the least recently used session is dropped once
+    max_sessions is reached. Sessions do not survive a restart and are not
+    shared between processes.
+    """
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sessionid):
+        with self._lock:
+            data = self._sessions.get(sessionid)
+            if data is None:
+                return None
+            self._sessions.move_to_end(sessionid)
+            return dict(data)
+
+    def save(self, sessionid, data):
+        with self._lock:
+            self._sessions[sessionid] = dict(data)
+            self._sessions.move_to_end(sessionid)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sessionid):
+        with self._lock:
+            self._sessions.pop(sessionid, None)
+
+    def sweep(self, before, limit=1000):
+        # the least recently used sessions come first, stop at the first live one
+        removed = 0
+        with self._lock:
+            for sessionid in list(self._sessions)[:limit]:
+                if self._sessions[sessionid].get('_utm', 0) >= before:
+                    break
+                del self._sessions[sessionid]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions kept in a single SQLite table in WAL mode. Writes are committed in
+    batches, every commit_every writes or commit_interval seconds, whichever
+    comes first. A background thread commits a batch that no further writes
+    arrive for, so the write transaction is never left open.
+    """
+
+    def __init__(self, path='sessions.db', commit_every=100, commit_interval=1.0):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._last_commit = time.time()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._stopped = None
+        self.reopen()
+
+    def reopen(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY NOT NULL,
+                data TEXT NOT NULL,
+                utm REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_utm ON sessions (utm)')
+        self._conn.commit()
+        self._pending = 0
+        self._last_commit = time.time()
+        if self.commit_interval:
+            self._stopped = threading.Event()
+            threading.Thread(target=self._commit_loop, args=(self._stopped,), name='px-session-commit',
+                             daemon=True).start()
+
+    def _commit_loop(self, stopped):
+        while not stopped.wait(self.commit_interval):
+            with self._lock:
+                if not self._pending or stopped.is_set():
+                    continue
+                try:
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    print('Session commit failed: {}'.format(e))
+                    continue
+                self._pending = 0
+                self._last_commit = time.time()
+
+    def _written(self):
+        self._pending += 1
+        now = time.time()
+        if self._pending >= self.commit_every or now - self._last_commit >= self.commit_interval:
+            self._conn.commit()
+            self._pending = 0
+            self._last_commit = now
+
+    def load(self, sessionid):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM sessions WHERE sid = ?', (sessionid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sessionid, data):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO sessions (sid, data, utm) VALUES (?,?,?)',
+                               (sessionid, json.dumps(data), data.get('_utm', time.time())))
+            self._written()
+
+    def delete(self, sessionid):
+        with self._lock:
+            self._conn.execute('DELETE FROM sessions WHERE sid = ?', (sessionid,))
+            self._written()
+
+    def sweep(self, before, limit=1000):
+        with self._lock:
+            removed = self._conn.execute('''
+                DELETE FROM sessions WHERE sid IN (SELECT sid FROM sessions WHERE utm < ? LIMIT ?)
+            ''', (before, limit)).rowcount
+            self._conn.commit()
+            self._pending = 0
+            self._last_commit = time.time()
+        return removed
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+            self._last_commit = time.time()
+
+    def close(self):
+        if self._stopped is not None:
+            self._stopped.set()
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def create_store(backend='file', **kwargs):
+    """
+    Returns a session store for backend, which is one of 'file', 'memory' or
+    'sqlite', or an existing SessionStore which is returned as it is.
+    kwargs are passed to the store's constructor.
+    """
+    if isinstance(backend, SessionStore):
+        return backend
+    stores = {'file': FileSessionStore, 'memory': MemorySessionStore, 'sqlite': SQLiteSessionStore}
+    if backend not in stores:
+        raise ValueError('Unknown session backend "{}"'.format(backend))
+    return stores[backend](**kwargs)
+
+
 class Session(object):
 
     def __init__(self, session_dir="/tmp", cookie_name='px.session',
-                 cookie_lifetime=None):
+                 cookie_lifetime=None, write_behind=False, store=None, lazy=False):
         self.session_dir = session_dir
+        self.store = store if store is not None else FileSessionStore(session_dir)
         self.cookie_name = cookie_name
         self.sessionid = None
+        self.write_behind = write_behind
+        self.lazy = lazy
+        self.dirty = False
+        self._expire_checked = False
+        self._cookie_pending = False
         if cookie_lifetime is None:
             self.ttl = MAX_TTL
             self.max_age = None
@@ -80,27 +386,49 @@ class Session(object):
         return self.load_session(self.cookie_value)
 
     def load_session(self, cookie_value):
-        self.sessionid = uuid.UUID(cookie_value).hex
-        fileName = os.path.join(self.session_dir, 'sess-px-%s' % self.sessionid)
-        if os.path.exists(fileName):
-            with open(fileName, 'r') as fp:
-                self.data = json.load(fp)
-        else:
+        try:
+            self.sessionid = uuid.UUID(cookie_value).hex
+        except ValueError:
+            self.new_session()
+            return
+        self.data = self.store.load(self.sessionid)
+        if self.data is None:
             self.new_session()
 
     def new_session(self):
         uid = getUuid()
         self.sessionid = uid.hex
-        self.set_cookie(self.sessionid)
         self.data = {'_ttl': self.ttl, '_utm': time.time(), '_sid': self.sessionid}
-        self.save()
+        self._expire_checked = True
+        self._cookie_pending = True
+        if self.lazy:
+            # nothing is stored and no cookie is sent until the session is written to
+            return
+        self._modified()
 
     def save(self):
-        fileName = os.path.join(self.session_dir, 'sess-px-%s' % self.sessionid)
-        with open(fileName, 'w') as fp:
-            json.dump(self.data, fp)
+        if self._cookie_pending:
+            self.set_cookie(self.sessionid)
+            self._cookie_pending = False
+        self.store.save(self.sessionid, self.data)
+        self.dirty = False
+
+    def _modified(self):
+        if self.write_behind:
+            self.dirty = True
+        else:
+            self.save()
+
+    def flush(self):
+        """Writes the session once if it has been modified since it was loaded."""
+        if self.dirty:
+            self.save()
 
     def expire(self):
+        # a session object only lives for one request, so checking once is enough
+        if self._expire_checked:
+            return
+        self._expire_checked = True
         now = time.time()
         if self.data['_utm'] > (now-self.data['_ttl']):
             self.data['_utm']=now
@@ -108,9 +436,7 @@ class Session(object):
             self.regenerate()
 
     def destroy(self):
-        fileName = os.path.join(self.session_dir, 'sess-px-%s' % self.sessionid)
-        if os.path.exists(fileName):
-            os.remove(fileName)
+        self.store.delete(self.sessionid)
         response.delete_cookie(self.cookie_name)
 
     def regenerate(self):
@@ -125,6 +451,7 @@ class Session(object):
 
     def __delitem__(self, key):
         del self.data[key]
+        self._modified()
 
     def __getitem__(self, key):
         self.expire()
@@ -136,7 +463,7 @@ class Session(object):
     def __setitem__(self, key,value):
         self.expire()
         self.data[key]=value
-        self.save()
+        self._modified()
 
     def __len__(self):
         return len(self.data)
@@ -164,16 +491,193 @@ class Session(object):
         return list(self.data.values())
 
 
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class CookieSession(Session):
+    """
+    Session whose data is kept in the cookie itself as compact JSON, signed with
+    HMAC-SHA256 and optionally encrypted with cipher, an object with
+    encrypt(str) -> base64 and decrypt(base64) -> str such as astatine.AstatineAES.
+
+    If the encoded cookie would be longer than max_size, the data is written to
+    the server-side store instead and the cookie only carries a signed reference
+    to it.
+    """
+
+    def __init__(self, session_dir="/tmp", cookie_name='px.session',
+                 cookie_lifetime=None, write_behind=False, store=None, lazy=False,
+                 secret=None, cipher=None, max_size=3800):
+        if not secret:
+            raise ValueError('CookieSession needs a secret to sign its cookies')
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.cipher = cipher
+        self.max_size = max_size
+        self._stored = False
+        Session.__init__(self, session_dir, cookie_name, cookie_lifetime,
+                         write_behind, store, lazy)
+
+    def _sign(self, kind, payload):
+        mac = hmac.new(self.secret, '{}.{}'.format(kind, payload).encode('ascii'), hashlib.sha256)
+        return _b64encode(mac.digest())
+
+    def encode(self, data):
+        text = json.dumps(data, separators=(',', ':'))
+        raw = base64.b64decode(self.cipher.encrypt(text)) if self.cipher else text.encode('utf-8')
+        payload = _b64encode(raw)
+        return 'c.{}.{}'.format(payload, self._sign('c', payload))
+
+    def decode(self, cookie_value):
+        """Returns the session data for a cookie, or None if it is invalid or has been tampered with."""
+        kind, _, rest = cookie_value.partition('.')
+        payload, _, mac = rest.rpartition('.')
+        if kind not in ('c', 's') or not hmac.compare_digest(mac, self._sign(kind, payload)):
+            return None
+        if kind == 's':
+            self._stored = True
+            return self.store.load(payload)
+        try:
+            raw = _b64decode(payload)
+            text = self.cipher.decrypt(base64.b64encode(raw)) if self.cipher else raw.decode('utf-8')
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    def load_session(self, cookie_value):
+        self.data = self.decode(cookie_value)
+        if self.data is None or '_sid' not in self.data:
+            self._stored = False
+            self.new_session()
+        else:
+            self.sessionid = self.data['_sid']
+
+    def save(self):
+        value = self.encode(self.data)
+        if len(value) > self.max_size:
+            self.store.save(self.sessionid, self.data)
+            self._stored = True
+            value = 's.{}.{}'.format(self.sessionid, self._sign('s', self.sessionid))
+        elif self._stored:
+            self.store.delete(self.sessionid)
+            self._stored = False
+        self.set_cookie(value)
+        self._cookie_pending = False
+        self.dirty = False
+
+    def destroy(self):
+        if self._stored:
+            self.store.delete(self.sessionid)
+            self._stored = False
+        response.delete_cookie(self.cookie_name)
+
+
+class SessionSweeper(threading.Thread):
+    """
+    Daemon thread that deletes expired sessions from a store, at most batch
+    sessions every interval seconds, so a large store is never scanned at once.
+    """
+
+    def __init__(self, store, ttl, interval=60, batch=1000):
+        threading.Thread.__init__(self, name='px-session-sweeper', daemon=True)
+        self.store = store
+        self.ttl = ttl
+        self.interval = interval
+        self.batch = batch
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.store.sweep(time.time() - self.ttl, self.batch)
+            except Exception as e:
+                print('Session sweep failed: {}'.format(e))
+
+    def stop(self):
+        self._stopped.set()
+
+
+class LazySession(object):
+    """
+    Stands in for a Session and only creates it, reading the cookie and the
+    store, the first time the session is used. Handlers that never touch their
+    session cost no session I/O at all.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._session_class = kwargs.pop('session_class', Session)
+        self._observe = kwargs.pop('observe', None)
+        self._args = args
+        self._kwargs = kwargs
+        self._session = None
+
+    @property
+    def loaded(self):
+        return self._session is not None
+
+    @property
+    def session(self):
+        if self._session is None:
+            if self._observe is None:
+                self._session = self._session_class(*self._args, **self._kwargs)
+            else:
+                start = time.perf_counter()
+                self._session = self._session_class(*self._args, **self._kwargs)
+                self._observe('session_load', time.perf_counter() - start)
+        return self._session
+
+    def flush(self):
+        if self._session is not None:
+            self._session.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def __contains__(self, key):
+        return key in self.session
+
+    def __delitem__(self, key):
+        del self.session[key]
+
+    def __getitem__(self, key):
+        return self.session[key]
+
+    def __setitem__(self, key, value):
+        self.session[key] = value
+
+    def __len__(self):
+        return len(self.session)
+
+    def __iter__(self):
+        return iter(self.session)
+
+
 class SessionPlugin(object):
     name = 'session'
     api = 2
 
     def __init__(self, session_dir="/tmp", cookie_name='px.session',
-                 cookie_lifetime=300, keyword='session'):
+                 cookie_lifetime=300, keyword='session', write_behind=False,
+                 store=None, lazy=False, secret=None, cipher=None, max_cookie_size=3800,
+                 sweep_interval=None, sweep_batch=1000, observe=None):
         self.session_dir = session_dir
+        self.observe = observe
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.sweeper = None
+        self.lazy = lazy
+        self.secret = secret
+        self.cipher = cipher
+        self.max_cookie_size = max_cookie_size
+        self.store = store if store is not None else FileSessionStore(session_dir)
         self.cookie_name = cookie_name
         self.cookie_lifetime = cookie_lifetime
         self.keyword = keyword
+        self.write_behind = write_behind
 
     def setup(self, app):
         for other in app.plugins:
@@ -181,6 +685,13 @@ class SessionPlugin(object):
             if other.keyword == self.keyword:
                 raise PluginError("Found another session plugin with "\
                 "conflicting settings (non-unique keyword).")
+        self._start_sweeper()
+
+    def _start_sweeper(self):
+        if self.sweep_interval and self.sweeper is None:
+            self.sweeper = SessionSweeper(self.store, self.cookie_lifetime or MAX_TTL,
+                                          self.sweep_interval, self.sweep_batch)
+            self.sweeper.start()
 
     def apply(self, callback, context):
         conf = context.config.get('session') or {}
@@ -189,11 +700,74 @@ class SessionPlugin(object):
         if self.keyword not in args:
             return callback
 
+        session_class, options = Session, {}
+        if self.secret:
+            session_class = CookieSession
+            options = {'secret': self.secret, 'cipher': self.cipher, 'max_size': self.max_cookie_size}
+        if self.lazy:
+            options['session_class'] = session_class
+            session_class = LazySession
+
         def wrapper(*args, **kwargs):
-            kwargs[self.keyword] = Session(self.session_dir,
-                                           self.cookie_name,
-                                           self.cookie_lifetime)
-            rv = callback(*args, **kwargs)
+            observe = self.observe
+            if self.lazy:
+                options['observe'] = observe
+            start = time.perf_counter()
+            session = session_class(self.session_dir,
+                                    self.cookie_name,
+                                    self.cookie_lifetime,
+                                    self.write_behind,
+                                    self.store,
+                                    self.lazy,
+                                    **options)
+            if observe is not None and not self.lazy:
+                observe('session_load', time.perf_counter() - start)
+            kwargs[self.keyword] = session
+            try:
+                rv = callback(*args, **kwargs)
+            except HTTPResponse as res:
+                # redirect() copies the response before a write-behind session is
+                # flushed, so the session cookie has to be carried over to it
+                if self.write_behind:
+                    self._flush(session, observe)
+                    self._carry_cookie(res)
+                raise
+            # write-behind sessions are written at most once, after the handler has finished
+            if self.write_behind:
+                self._flush(session, observe)
             return rv
         return wrapper
 
+    def _flush(self, session, observe):
+        if observe is None:
+            session.flush()
+            return
+        if self.lazy and not session.loaded or not session.dirty:
+            return
+        start = time.perf_counter()
+        session.flush()
+        observe('session_save', time.perf_counter() - start)
+
+    def _carry_cookie(self, res):
+        if res is response or not response._cookies or self.cookie_name not in response._cookies:
+            return
+        if res._cookies is None:
+            res._cookies = response._cookies.__class__()
+        res._cookies[self.cookie_name] = response._cookies[self.cookie_name]
+
+    def close(self):
+        if self.sweeper is not None:
+            self.sweeper.stop()
+            self.sweeper.join()
+            self.sweeper = None
+        self.store.close()
+
+    def reopen(self, sweep=True):
+        """
+        Reopens the store after close, e.g. in a forked worker process, and restarts
+        the sweeper if sweep is set, so that only one process needs to sweep.
+        """
+        self.store.reopen()
+        if sweep:
+            self._start_sweeper()
+